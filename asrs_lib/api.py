@@ -1,10 +1,45 @@
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi import Depends, FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import Optional, Tuple
+from contextlib import asynccontextmanager
 import asyncio
-from .utils import normalize_basket_id
+import orjson
+from .db import AsyncPg, Pg
+from .utils import BasketId, normalize_basket_id, to_basket_id
 
-app = FastAPI(title="ASRS WMS API", version="1.3.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Open the asyncpg pool and start the status broadcaster on the server's
+    event loop; tear both down on shutdown.  A pool that cannot be opened
+    aborts startup (as `Pg()` already does for the sync pool), so request
+    handlers never see a half-initialised app.
+    """
+    apg = AsyncPg()
+    await apg.open()
+    app.state.apg = apg
+    print("[API] async DB pool ready")
+
+    broadcaster = None
+    mover = getattr(app.state, "mover", None)
+    app.state.status_cond = asyncio.Condition()
+    # bumped on every publish; handlers wait for it to move past the last frame they sent
+    app.state.status_seq = 0
+    app.state.latest_status = (
+        _encode_status(mover.status_snapshot()) if mover is not None and mover.status_subscribed else None
+    )
+    if mover is not None:
+        broadcaster = asyncio.create_task(_status_broadcaster(mover))
+    try:
+        yield
+    finally:
+        if broadcaster is not None:
+            broadcaster.cancel()
+        await apg.close()
+
+app = FastAPI(title="ASRS WMS API", version="1.3.0", lifespan=lifespan,
+              default_response_class=ORJSONResponse)
 
 class PickRequest(BaseModel):
     number: Optional[int] = None
@@ -25,78 +60,113 @@ class BasketStatus(BaseModel):
     mapped_xyz: Optional[Tuple[int,int,int]] = None
     occupied_shelf_id: Optional[int] = None
 
+# --- Dependencies: shared components published on app.state by AsrsServiceApp ---
+def get_pg(request: Request) -> Pg:
+    pg = getattr(request.app.state, "pg", None)
+    if pg is None:
+        raise HTTPException(503, "DB not ready")
+    return pg
+
+def get_apg(request: Request) -> AsyncPg:
+    apg = getattr(request.app.state, "apg", None)
+    if apg is None:
+        raise HTTPException(503, "DB not ready")
+    return apg
+
+def get_mover(request: Request):
+    """Mover is optional: reset endpoints skip it when absent"""
+    return getattr(request.app.state, "mover", None)
+
+def get_qr(request: Request):
+    """QR listener is optional: reset endpoints skip it when absent"""
+    return getattr(request.app.state, "qr", None)
+
 # System status exposed via WebSocket
 
-def _resolve_basket_id(req: PickRequest | None, path_number: Optional[int] = None) -> str:
+def _resolve_basket_id(req: PickRequest | None, path_number: Optional[int] = None) -> BasketId:
     """Convert request parameters to normalized basket ID string"""
     if path_number is not None:
-        return normalize_basket_id(path_number)
+        return to_basket_id(path_number)
     if req is None:
         raise HTTPException(400, "missing request body")
     try:
         if req.number is not None:
-            return normalize_basket_id(req.number)
+            return to_basket_id(req.number)
         if req.basket_id is not None:
-            return normalize_basket_id(req.basket_id)
+            return to_basket_id(req.basket_id)
     except ValueError as e:
         raise HTTPException(400, str(e))
     raise HTTPException(400, "either 'number' or 'basket_id' is required")
 
-@app.post("/wms/pick", response_model=PickResponse)
-def wms_pick(req: PickRequest):
-    pg = getattr(app.state, "pg", None)
-    if pg is None:
-        raise HTTPException(500, "DB not ready")
-
-    basket_id = _resolve_basket_id(req)
-    mapping = pg.get_mapping_for_basket(basket_id)
-    if not mapping:
-        raise HTTPException(404, f"basket '{basket_id}' not found in mapping")
-    shelf_id, x, y, z = mapping
-    # Check shelf usability before enqueuing pick
+async def _enqueue_pick(apg, basket_id: BasketId) -> PickResponse:
+    """Look up mapping + shelf usability in one query, then enqueue the pick"""
     try:
-        # If the shelf is marked unusable, do not enqueue and return an error
-        if not pg.shelf_can_use(shelf_id):
-            raise HTTPException(400, "This shelf can't use now.")
+        found = await apg.get_mapping_and_usability(basket_id)
     except Exception as e:
-        # If the DB check fails, return an internal error
         raise HTTPException(500, f"Error checking shelf usability: {e}")
+    if not found:
+        raise HTTPException(404, f"basket '{basket_id}' not found in mapping")
+    shelf_id, x, y, z, can_use = found
+    # If the shelf is marked unusable, do not enqueue and return an error
+    if not can_use:
+        raise HTTPException(400, "This shelf can't use now.")
 
-    qid = pg.enqueue_pick(basket_id, x, y, z)
-    return PickResponse(basket_id=basket_id, shelf_id=shelf_id, x=x, y=y, z=z, queue_id=qid)
+    qid = await apg.enqueue_pick(basket_id, x, y, z)
+    # Values come straight from the DB / normalize_basket_id; skip re-validation
+    return PickResponse.model_construct(basket_id=basket_id, shelf_id=shelf_id, x=x, y=y, z=z, queue_id=qid)
 
-@app.post("/wms/pick/{number}", response_model=PickResponse)
-def wms_pick_number(number: int):
-    pg = getattr(app.state, "pg", None)
-    if pg is None:
-        raise HTTPException(500, "DB not ready")
-    basket_id = _resolve_basket_id(None, path_number=number)
-    mapping = pg.get_mapping_for_basket(basket_id)
-    if not mapping:
-        raise HTTPException(404, f"basket '{basket_id}' not found in mapping")
-    shelf_id, x, y, z = mapping
-    # Check shelf usability before enqueuing pick by number
+@app.post("/wms/pick", response_model=PickResponse)
+async def wms_pick(req: PickRequest, apg: AsyncPg = Depends(get_apg)):
+    basket_id = _resolve_basket_id(req)
+    return await _enqueue_pick(apg, basket_id)
+
+async def wms_pick_fast(request: Request) -> ORJSONResponse:
+    """
+    High-throughput variant of POST /wms/pick.  Registered as a plain Starlette
+    route, so there is no Pydantic request parsing or response-model pass:
+    the body is decoded with orjson and the response is written directly.
+    Accepts the same body and returns the same JSON as /wms/pick; keep using
+    /wms/pick where the validated, documented contract matters.
+    """
+    # Plain Starlette route: no Depends(), resolve the pool directly
+    apg = get_apg(request)
     try:
-        if not pg.shelf_can_use(shelf_id):
-            raise HTTPException(400, "This shelf can't use now.")
-    except Exception as e:
-        raise HTTPException(500, f"Error checking shelf usability: {e}")
+        body = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(400, "invalid JSON body")
+    if not isinstance(body, dict):
+        raise HTTPException(400, "missing request body")
+
+    number, basket = body.get("number"), body.get("basket_id")
+    # model_construct() skips validation: reject what PickRequest would refuse
+    # (objects, lists, floats, bools) before it reaches to_basket_id()
+    for field, value in (("number", number), ("basket_id", basket)):
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (int, str))):
+            raise HTTPException(400, f"'{field}' must be an integer or a string")
+    req = PickRequest.model_construct(number=number, basket_id=basket)
+    basket_id = _resolve_basket_id(req)
+    return ORJSONResponse(dict(await _enqueue_pick(apg, basket_id)))
+
+# Must be registered before /wms/pick/{number}, which would otherwise match "fast"
+app.router.add_route("/wms/pick/fast", wms_pick_fast, methods=["POST"])
 
-    qid = pg.enqueue_pick(basket_id, x, y, z)
-    return PickResponse(basket_id=basket_id, shelf_id=shelf_id, x=x, y=y, z=z, queue_id=qid)
+@app.post("/wms/pick/{number}", response_model=PickResponse)
+async def wms_pick_number(number: int, apg: AsyncPg = Depends(get_apg)):
+    basket_id = _resolve_basket_id(None, path_number=number)
+    return await _enqueue_pick(apg, basket_id)
 
 @app.get("/wms/status/basket/{basket}", response_model=BasketStatus)
-def basket_status(basket: str):
-    pg = getattr(app.state, "pg", None)
-    if pg is None:
-        raise HTTPException(500, "DB not ready")
+async def basket_status(basket: str, apg: AsyncPg = Depends(get_apg)):
     try:
-        norm_id = normalize_basket_id(basket)
+        norm_id = to_basket_id(basket)
     except ValueError as e:
         raise HTTPException(400, str(e))
-    mapping = pg.get_mapping_for_basket(norm_id)
-    occ = pg.get_shelf_of_basket(norm_id)
-    return BasketStatus(
+    # Mapping and occupancy are independent lookups; run them on two pooled connections
+    mapping, occ = await asyncio.gather(
+        apg.get_mapping_for_basket(norm_id),
+        apg.get_shelf_of_basket(norm_id),
+    )
+    return BasketStatus.model_construct(
         basket_id=norm_id,
         mapped_shelf_id=(mapping[0] if mapping else None),
         mapped_xyz=(mapping[1], mapping[2], mapping[3]) if mapping else None,
@@ -114,7 +184,7 @@ def normalize(value: str):
 
 # --- Reset endpoints ---
 @app.post("/wms/reset/queue")
-def reset_queue():
+def reset_queue(pg: Pg = Depends(get_pg)):
     """
     Clear all pending commands from the queues in database.
     This is a soft reset that only affects pending operations.
@@ -122,10 +192,6 @@ def reset_queue():
     Returns:
         dict: Status of the queue reset operation.
     """
-    pg = getattr(app.state, "pg", None)
-    if pg is None:
-        raise HTTPException(500, "DB not ready")
-
     try:
         # Clear both PICK and PUT queues
         pg.clear_all_queues()
@@ -141,7 +207,7 @@ def reset_queue():
         raise HTTPException(500, f"Failed to clear queues: {str(e)}")
 
 @app.post("/wms/reset/system")
-def reset_system():
+async def reset_system(pg: Pg = Depends(get_pg), mover=Depends(get_mover), qr=Depends(get_qr)):
     """
     Complete system reset including:
     - Clear all queues in database
@@ -149,42 +215,31 @@ def reset_system():
     - Reset QR listener state
     - Reset all ongoing operations
 
+    The three resets are independent, so they run concurrently in worker
+    threads and the endpoint takes as long as the slowest one.
+
     Returns:
         dict: Detailed status of all reset operations.
     """
     error_messages = []
     success_messages = []
 
-    # Access the database and mover from FastAPI state
-    pg = getattr(app.state, "pg", None)
-    mover = getattr(app.state, "mover", None)
-    qr = getattr(app.state, "qr", None)
-
-    if pg is None:
-        raise HTTPException(500, "DB not ready")
-    # 1. Clear database queues
-    try:
-        pg.clear_all_queues()
-        success_messages.append("Queue cleared successfully")
-    except Exception as e:
-        error_messages.append(f"Error clearing queue: {str(e)}")
-
-    # 2. Reset mover state
+    # (call, success message, error prefix) — 1. DB queues, 2. mover, 3. QR listener
+    jobs = [(pg.clear_all_queues, "Queue cleared successfully", "Error clearing queue")]
     if mover is not None:
-        try:
-            mover.reset_current_command()
-            success_messages.append("Mover reset successfully")
-        except Exception as e:
-            error_messages.append(f"Error resetting mover: {str(e)}")
-    
-    # 3. Reset QR listener state
+        jobs.append((mover.reset_current_command, "Mover reset successfully", "Error resetting mover"))
     if qr is not None:
-        try:
-            qr.reset_state()
-            success_messages.append("QR listener reset successfully")
-        except Exception as e:
-            error_messages.append(f"Error resetting QR listener: {str(e)}")
-    
+        jobs.append((qr.reset_state, "QR listener reset successfully", "Error resetting QR listener"))
+
+    results = await asyncio.gather(
+        *(asyncio.to_thread(fn) for fn, _, _ in jobs), return_exceptions=True
+    )
+    for (_, ok_msg, err_prefix), result in zip(jobs, results):
+        if isinstance(result, Exception):
+            error_messages.append(f"{err_prefix}: {str(result)}")
+        else:
+            success_messages.append(ok_msg)
+
     # Return status
     if error_messages:
         return {
@@ -201,75 +256,123 @@ def reset_system():
         }
 
 # WebSocket endpoint to stream system status (ready, auto, alarm) to WMS.
+STATUS_HEARTBEAT_S = 15.0
+
+def _encode_status(snapshot: dict) -> tuple[str, bool]:
+    """Encode a status snapshot once for all clients: (JSON text frame, is_error)."""
+    return orjson.dumps(snapshot).decode(), "error" in snapshot
+
+async def _status_broadcaster(mover):
+    """
+    Single producer for /ws/status/system.  Waits for snapshots pushed by the
+    mover's OPC UA subscription (or, without a subscription, does one batched
+    read per second), encodes the result once into app.state.latest_status
+    and wakes every connected client through app.state.status_cond.  OPC UA
+    reads and JSON encoding are therefore independent of the number of
+    connected clients.
+    """
+    loop = asyncio.get_running_loop()
+    cond = app.state.status_cond
+    updates: asyncio.Queue = asyncio.Queue()
+
+    def on_status(snapshot: dict):
+        # Called on the OPC UA subscription / mover thread
+        loop.call_soon_threadsafe(updates.put_nowait, snapshot)
+
+    mover.add_status_listener(on_status)
+    try:
+        while True:
+            timeout = STATUS_HEARTBEAT_S if mover.status_subscribed else 1.0
+            try:
+                snapshot = await asyncio.wait_for(updates.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                # Heartbeat: re-publish so clients detect dead peers on send
+                snapshot = mover.status_snapshot()
+            if not mover.status_subscribed:
+                try:
+                    # One batched OPC UA read per tick, off the event loop
+                    ready, auto, alarm = await asyncio.to_thread(mover.read_status)
+                    snapshot = {**mover.status_snapshot(), "ready": ready, "auto_mode": auto, "alarm": alarm}
+                except Exception as e:
+                    snapshot = {"error": str(e)}
+            latest = _encode_status(snapshot)
+            async with cond:
+                app.state.latest_status = latest
+                app.state.status_seq += 1
+                cond.notify_all()
+    finally:
+        mover.remove_status_listener(on_status)
+
+async def _wait_disconnect(ws: WebSocket):
+    """Return once the peer disconnects; status clients never send data."""
+    while True:
+        message = await ws.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
 @app.websocket("/ws/status/system")
 async def ws_system_status(ws: WebSocket):
     """
     A WebSocket endpoint that streams the ASRS system status to the client.
 
-    Upon connection, the server will repeatedly read the ready, auto mode and
-    alarm flags from the ASRS mover and send them as JSON objects to the
-    connected WebSocket client.  The loop runs until the client disconnects
-    or an error occurs.  Read operations are executed in a threadpool to
-    avoid blocking the event loop.
+    Every connection shares the pre-encoded frame published by
+    `_status_broadcaster`: the handler waits on app.state.status_cond until
+    app.state.status_seq moves past the last frame it sent, then sends the
+    latest frame (on change, on put/pick completion and on the
+    STATUS_HEARTBEAT_S heartbeat).  A publish that lands while a frame is
+    being sent is therefore never missed.  If the broadcaster reports a read error
+    it is sent to the client and the connection is closed.
 
     The JSON message format is:
 
-        {"ready": true/false, "auto_mode": true/false, "alarm": true/false}
+        {"ready": true/false, "auto_mode": true/false, "alarm": true/false,
+         "last_put_seconds": float|null, "last_pick_seconds": float|null}
 
     """
     mover = getattr(app.state, "mover", None)
+    cond = getattr(app.state, "status_cond", None)
     # Reject connection if the mover is unavailable
-    if mover is None:
+    if mover is None or cond is None:
         # Accept then immediately close so that the client receives a valid
         # WebSocket handshake response before termination
         await ws.accept()
         await ws.close()
         return
     await ws.accept()
-    loop = asyncio.get_event_loop()
+
+    async def next_status(seen: int):
+        async with cond:
+            await cond.wait_for(lambda: app.state.status_seq != seen)
+            return app.state.status_seq, app.state.latest_status
+
+    # Watch for the client (or uvicorn's graceful shutdown) closing the socket
+    # so the handler does not sit in cond.wait() until the next heartbeat.
+    disconnected = asyncio.create_task(_wait_disconnect(ws))
     try:
+        async with cond:
+            seen = app.state.status_seq
+            latest = app.state.latest_status
         while True:
             if getattr(app.state, "shutting_down", False):
                 await ws.close()
                 break
-            try:
-                # Run the blocking OPC UA reads in the default thread pool
-                ready = await loop.run_in_executor(None, lambda: bool(mover.n_ready.get_value()))
-                auto  = await loop.run_in_executor(None, lambda: bool(mover.n_auto.get_value()))
-                alarm = await loop.run_in_executor(None, lambda: bool(mover.n_alarm.get_value()))
-            except asyncio.CancelledError:
-                await ws.close()
+            if latest is not None:
+                frame, is_error = latest
+                # Text frame: status.html parses event.data with JSON.parse
+                await ws.send_text(frame)
+                if is_error:
+                    break
+            update = asyncio.create_task(next_status(seen))
+            await asyncio.wait({update, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+            if not update.done():
+                update.cancel()
                 break
-            except Exception as e:
-                # Send error then break out of loop on read failure
-                await ws.send_json({"error": str(e)})
-                break
-            # Include timing information for last put/pick commands (rounded to 2 decimals)
-            try:
-                last_put  = mover.last_durations.get("put") if hasattr(mover, "last_durations") else None
-                last_pick = mover.last_durations.get("pick") if hasattr(mover, "last_durations") else None
-                payload = {
-                    "ready": ready,
-                    "auto_mode": auto,
-                    "alarm": alarm,
-                    "last_put_seconds": None if last_put is None else round(last_put, 2),
-                    "last_pick_seconds": None if last_pick is None else round(last_pick, 2),
-                }
-            except Exception:
-                # Fallback if reading durations fails
-                payload = {
-                    "ready": ready,
-                    "auto_mode": auto,
-                    "alarm": alarm,
-                    "last_put_seconds": None,
-                    "last_pick_seconds": None,
-                }
-            await ws.send_json(payload)
-            # Wait a short period before reading again. Adjust interval as needed.
-            await asyncio.sleep(1.0)
+            seen, latest = update.result()
     except WebSocketDisconnect:
         # Client disconnected; nothing to do
         pass
     except Exception:
         # Silently ignore other errors; connection will be closed automatically
         pass
+    finally:
+        disconnected.cancel()
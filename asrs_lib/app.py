@@ -1,6 +1,16 @@
+import asyncio
+import logging
+import logging.handlers
+import queue
+import sys
 import threading
-import time
+from collections.abc import Mapping
 import uvicorn
+try:
+    import uvloop
+except ImportError:
+    # uvloop is not available on Windows; fall back to the default asyncio loop
+    uvloop = None
 from .config import load as load_config
 from .db import Pg
 from .opcua_nodes import OpcUaNodes
@@ -8,9 +18,29 @@ from .qr_listener import QrListener
 from .asrs_mover import AsrsMover
 from .api import app as fastapi_app
 
+def setup_logging(level: str = "INFO") -> logging.handlers.QueueListener:
+    """
+    Route the "asrs" loggers through a QueueHandler so the mover and QR
+    listener threads only enqueue records; a QueueListener thread formats
+    and writes them.
+    The caller stops the returned listener on shutdown (flushes the queue).
+    """
+    q = queue.SimpleQueue()
+    out = logging.StreamHandler(sys.stdout)
+    out.setFormatter(logging.Formatter("%(message)s"))  # same lines as the old print()
+    listener = logging.handlers.QueueListener(q, out, respect_handler_level=False)
+
+    logger = logging.getLogger("asrs")
+    logger.handlers[:] = [logging.handlers.QueueHandler(q)]
+    logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+    logger.propagate = False
+    listener.start()
+    return listener
+
 class AsrsServiceApp:
-    def __init__(self, config: dict | None = None):
+    def __init__(self, config: Mapping | None = None):
         self.cfg = config or load_config()
+        self._log_listener = setup_logging(self.cfg.get("LOG_LEVEL", "INFO"))
         self.pg = Pg()
         self.nodes = OpcUaNodes()
         self.qr = QrListener(self.cfg["OPCUA_ENDPOINT"], self.nodes, self.pg, interval=0.5)
@@ -25,10 +55,9 @@ class AsrsServiceApp:
         self.last_times = {"put": None, "pick": None}
         self.mover.on_cycle_done = self._on_cycle_done  # Update timing on completion
         fastapi_app.state.last_times = self.last_times  # Share timing with API
-        self._stop = False
         self._t_qr = None
         self._t_mv = None
-        self._t_api = None
+        # Set once on shutdown; the mover loop watches it directly
         self._shutdown_event = threading.Event()
 
     def _on_qr(self, qr_code: str):
@@ -61,46 +90,47 @@ class AsrsServiceApp:
         except Exception:
             pass
 
-    def _stop_flag(self):
-        return self._stop
-
     def start(self):
+        """Start the QR listener and mover threads (the API runs in `serve`)."""
         def run_qr():
             self.qr.start()
             self.qr.loop(callback=self._on_qr, edge_only=True, validate=True)
 
         def run_mover():
             self.mover.connect()
-            self.mover.loop(self._stop_flag)
-
-        def run_api():
-            import asyncio
-            config = uvicorn.Config(
-                app=fastapi_app,
-                host=self.cfg["API_HOST"],
-                port=self.cfg["API_PORT"],
-                log_level="info"
-            )
-            self.api_server = uvicorn.Server(config)
-            # สร้าง event loop ใหม่สำหรับ thread นี้
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            # รัน serve() ใน event loop
-            loop.run_until_complete(self.api_server.serve())
+            self.mover.loop(self._shutdown_event)
 
+        # Blocking OPC UA/DB loops stay on daemon threads: a job can block for
+        # minutes and must not hold up interpreter exit.
         self._t_qr = threading.Thread(target=run_qr, daemon=True)
         self._t_mv = threading.Thread(target=run_mover, daemon=True)
-        self._t_api = threading.Thread(target=run_api, daemon=True)
 
         self._t_qr.start()
         self._t_mv.start()
-        self._t_api.start()
+
+    async def serve(self):
+        """
+        Start the worker threads, then run uvicorn on the calling (main)
+        thread's event loop until it exits.  Running on the main thread lets
+        uvicorn install its SIGINT/SIGTERM handlers for graceful shutdown.
+        """
+        config = uvicorn.Config(
+            app=fastapi_app,
+            host=self.cfg["API_HOST"],
+            port=self.cfg["API_PORT"],
+            loop="uvloop" if uvloop else "asyncio",
+            http="httptools",
+            ws="websockets",
+            log_level="info"
+        )
+        self.api_server = uvicorn.Server(config)
+        self.start()
         print(f"[System] started. API on :{self.cfg['API_PORT']}")
+        await self.api_server.serve()
 
     def stop(self):
         print("[System] stopping gracefully...")
         # Signal all components to stop
-        self._stop = True
         self._shutdown_event.set()
 
         # Set shutting_down flag for WebSocket connections
@@ -120,22 +150,10 @@ class AsrsServiceApp:
         except Exception as e:
             print(f"[System] Error disconnecting mover: {e}")
 
-        # Stop API server gracefully
-        if self.api_server:
-            try:
-                self.api_server.should_exit = True
-                print("[System] API server stopping...")
-            except Exception as e:
-                print(f"[System] Error stopping API server: {e}")
-
-        # Give WebSocket connections and API server time to close gracefully
-        time.sleep(2.0)
-
         # Wait for threads to finish (with timeout)
         threads = [
             (self._t_qr, "QR Thread"),
             (self._t_mv, "Mover Thread"),
-            (self._t_api, "API Thread")
         ]
         
         for thread, name in threads:
@@ -147,15 +165,20 @@ class AsrsServiceApp:
                 except Exception as e:
                     print(f"[System] Error waiting for {name}: {e}")
 
+        self.pg.close()
         print("[System] stopped.")
+        try:
+            self._log_listener.stop()
+        except Exception:
+            pass
 
 def main():
     app = AsrsServiceApp()
     try:
-        app.start()
-        # Use event to wait instead of sleep loop
-        while not app._shutdown_event.wait(0.5):
-            pass
+        if uvloop:
+            uvloop.run(app.serve())
+        else:
+            asyncio.run(app.serve())
     except KeyboardInterrupt:
         print("\n[System] Received shutdown signal (Ctrl+C)")
     finally:
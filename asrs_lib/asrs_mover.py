@@ -1,15 +1,90 @@
 # ASRS movement control and command execution
 import time
+import logging
+import random
+import select
 import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from typing import Optional
 from opcua import Client, ua
 
 try:
     from .opcua_nodes import OpcUaNodes
-    from .utils import encoder_to_position
+    from .utils import BasketId
 except ImportError:
     from opcua_nodes import OpcUaNodes
-    from utils import encoder_to_position
+    from utils import BasketId
+
+log = logging.getLogger("asrs.mover")
+
+
+# AsrsMover._n holds ack, complete, plc_req_qr, ready, auto, alarm (in that order).
+# COMPLETE..ALARM is contiguous so it can be sliced for the batched read.
+IDX_COMPLETE = 1
+IDX_ALARM = 5
+
+# iiii M XX YY Z bbbbbbbbbb
+_CMD_FMT = "%04d%s%02d%02d%d%s"
+
+# Prebuilt write values for the hot path (the client only serializes them).
+# DO NOT set dv.ServerTimestamp or dv.SourceTimestamp
+_DV_TRUE = ua.DataValue(ua.Variant(True, ua.VariantType.Boolean))
+_DV_FALSE = ua.DataValue(ua.Variant(False, ua.VariantType.Boolean))
+_DV_EMPTY_STR = ua.DataValue(ua.Variant("", ua.VariantType.String))
+
+
+class _NodeCache:
+    """
+    Latest values of the subscribed PLC nodes, kept current by OPC UA
+    data-change notifications.  python-opcua delivers notifications on the
+    client's receive thread, so nothing here may issue OPC UA requests:
+    waiters are woken through a Condition and callbacks must only record
+    state or set events.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._callbacks = {}
+
+    def on_change(self, node, cb):
+        """Call cb(value) on every notification for node (receive thread)."""
+        self._callbacks.setdefault(node.nodeid, []).append(cb)
+
+    def has(self, node) -> bool:
+        return node is not None and node.nodeid in self._values
+
+    def get(self, node):
+        return self._values[node.nodeid]
+
+    def wait_for(self, node, want: bool, timeout_s: float) -> bool:
+        nodeid = node.nodeid
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: nodeid in self._values and bool(self._values[nodeid]) == want,
+                timeout_s,
+            )
+
+    def version(self) -> int:
+        """Bumped on every notification; pass to wait_change()."""
+        return self._seq
+
+    def wait_change(self, since: int, timeout_s: float) -> bool:
+        """Block until any subscribed node changes after version `since`."""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._seq != since, timeout_s)
+
+    def datachange_notification(self, node, val, data):
+        with self._cond:
+            self._values[node.nodeid] = val
+            self._seq += 1
+            self._cond.notify_all()
+        for cb in self._callbacks.get(node.nodeid, ()):
+            try:
+                cb(val)
+            except Exception as e:
+                log.warning("[Mover] data-change callback error: %s", e)
 
 
 class AsrsMover:
@@ -22,25 +97,41 @@ class AsrsMover:
 
         self._send_lock = threading.Lock()
         self._last_cmd_info = None
-        self._current_xyz = (1, 1, 0)   # Current position (column, row, depth)
-        self._enc_raw = (None, None, None)
         # Clear-request monitoring
         self.n_plc_req_clear = None
         self.n_wms_clear_reply_node = None
         self._clear_monitor_thread = None
         self._clear_monitor_stop = False
-        self._pending_clear = False
+        self._clear_requested = threading.Event()
+
+        # Subscription-backed cache of handshake/status nodes (None -> poll)
+        self._cache: Optional[_NodeCache] = None
+        self._sub = None
+        self._registered = []   # nodes returned by RegisterNodes (unregistered on disconnect)
+        self._n = [None] * (IDX_ALARM + 1)  # ack..alarm (filled in connect())
+        self._poll_nodes = []   # complete, plc_req_qr, ready, auto, alarm (see _poll_job_signals)
+
+        # DB updates after ACK run here so they overlap the complete-wait
+        # (created by connect(), shut down by disconnect())
+        self._exec: Optional[ThreadPoolExecutor] = None
+
+        # LISTEN connection on the queue channel (None -> poll every 100 ms
+        # and retry LISTEN at _listen_retry_at, backing off up to 30 s)
+        self._queue_listener = None
+        self._listen_retry_at = 0.0
+        self._listen_backoff = 1.0
         
         self.on_cycle_done = None
         self.last_durations = {"put": None, "pick": None}
+        # Same durations rounded to 2 decimals once per job, as published to WS clients
+        self._last_seconds = {"put": None, "pick": None}
 
-    # Data value helpers
-    @staticmethod
-    def _dv_bool(v: bool):
-        dv = ua.DataValue(ua.Variant(v, ua.VariantType.Boolean))
-        # DO NOT set dv.ServerTimestamp or dv.SourceTimestamp
-        return dv
+        # Status flags pushed by the OPC UA subscription, fanned out to listeners
+        self._status = {"ready": False, "auto_mode": False, "alarm": False}
+        self._status_listeners = []
+        self._status_lock = threading.Lock()
 
+    # Data value helpers
     @staticmethod
     def _dv_str(s: str):
         dv = ua.DataValue(ua.Variant(s, ua.VariantType.String))
@@ -51,17 +142,54 @@ class AsrsMover:
     # -------- low-level --------
     def _pulse(self, node, width_s: float = 0.05):
         try:
-            node.set_value(self._dv_bool(True))
+            node.set_value(_DV_TRUE)
             time.sleep(width_s)
         finally:
             try:
-                node.set_value(self._dv_bool(False))
+                node.set_value(_DV_FALSE)
             except Exception:
                 pass
 
+    def _write_many(self, pairs):
+        """
+        Write several (node, DataValue) pairs in one OPC UA Write request.
+        Returns one bool per pair; falls back to per-node set_value when the
+        batched request itself fails.
+        """
+        params = ua.WriteParameters()
+        for node, dv in pairs:
+            wv = ua.WriteValue()
+            wv.NodeId = node.nodeid
+            wv.AttributeId = ua.AttributeIds.Value
+            wv.Value = dv
+            params.NodesToWrite.append(wv)
+        try:
+            results = self.client.uaclient.write(params)
+            return [r.is_good() for r in results]
+        except Exception:
+            ok = []
+            for node, dv in pairs:
+                try:
+                    node.set_value(dv)
+                    ok.append(True)
+                except Exception:
+                    ok.append(False)
+            return ok
+
+    def _read(self, node):
+        """Latest value of node: from the subscription cache when available."""
+        cache = self._cache
+        if cache is not None and cache.has(node):
+            return cache.get(node)
+        return node.get_value()
+
     def _wait(self, node, want: bool, timeout_s: float) -> bool:
-        t0 = time.time()
-        while time.time() - t0 < timeout_s:
+        cache = self._cache
+        if cache is not None and cache.has(node):
+            # Event-driven: woken by the data-change notification, no polling
+            return cache.wait_for(node, want, timeout_s)
+        t0 = time.monotonic()
+        while time.monotonic() - t0 < timeout_s:
             try:
                 if bool(node.get_value()) == want:
                     return True
@@ -70,17 +198,127 @@ class AsrsMover:
             time.sleep(0.02)
         return False
 
+    def read_status(self) -> tuple[bool, bool, bool]:
+        """Read (ready, auto, alarm) in a single batched OPC UA Read request."""
+        ready, auto, alarm = self.client.get_values([self.n_ready, self.n_auto, self.n_alarm])
+        return bool(ready), bool(auto), bool(alarm)
+
+    # -------- status push (subscription) --------
+    @property
+    def status_subscribed(self) -> bool:
+        return self._sub is not None
+
+    def add_status_listener(self, cb):
+        """Register cb(snapshot: dict); called on every status change and job completion."""
+        with self._status_lock:
+            self._status_listeners.append(cb)
+
+    def remove_status_listener(self, cb):
+        with self._status_lock:
+            try: self._status_listeners.remove(cb)
+            except ValueError: pass
+
+    def status_snapshot(self) -> dict:
+        return {
+            **self._status,
+            "last_put_seconds": self._last_seconds["put"],
+            "last_pick_seconds": self._last_seconds["pick"],
+        }
+
+    def _notify_status(self):
+        with self._status_lock:
+            listeners = list(self._status_listeners)
+        if not listeners:
+            return
+        snapshot = self.status_snapshot()
+        for cb in listeners:
+            try:
+                cb(snapshot)
+            except Exception as e:
+                log.warning("[Mover] status listener error: %s", e)
+
+    def _on_status_change(self, key: str, val):
+        # Runs on the OPC UA receive thread: no blocking OPC UA calls here
+        self._status = {**self._status, key: bool(val)}
+        self._notify_status()
+
+    def _subscribe(self):
+        """
+        One subscription for every node the mover waits on.  The cache then
+        serves `_read` / `_wait` / `_system_ready` without OPC UA round-trips,
+        pushes status changes to listeners and wakes the clear monitor.
+        """
+        cache = _NodeCache()
+        for node, key in ((self.n_ready, "ready"), (self.n_auto, "auto_mode"), (self.n_alarm, "alarm")):
+            cache.on_change(node, lambda val, key=key: self._on_status_change(key, val))
+
+        watched = list(self._n)
+        if self.n_plc_req_clear is not None:
+            cache.on_change(self.n_plc_req_clear, lambda val: val and self._clear_requested.set())
+            watched.append(self.n_plc_req_clear)
+        # plc_req_wms_clear may share a node with a watched one (same registered id,
+        # see _register_nodes): monitor each node once
+        unique = list({n.nodeid: n for n in watched}.values())
+        try:
+            self._sub = self.client.create_subscription(50, cache)
+            self._sub.subscribe_data_change(unique)
+            self._cache = cache
+        except Exception as e:
+            log.warning("[Mover] subscription failed, falling back to polling: %s", e)
+            self._sub = None
+            self._cache = None
+
+    # Nodes read/written on every job; RegisterNodes lets the server skip the NodeId lookup
+    _HOT_NODES = (
+        "n_cmd", "n_send", "n_ack", "n_complete", "n_complete_rpy",
+        "n_basket_qr", "n_plc_req_qr", "n_wms_recv_qr",
+        "n_ready", "n_auto", "n_alarm",
+    )
+
+    def _register_nodes(self):
+        plain = [getattr(self, name) for name in self._HOT_NODES]
+        try:
+            regs = self.client.register_nodes(plain)
+        except Exception as e:
+            log.warning("[Mover] RegisterNodes failed, using plain node ids: %s", e)
+            self._registered = []
+            return
+        for name, node in zip(self._HOT_NODES, regs):
+            setattr(self, name, node)
+        self._registered = regs
+        # Clear nodes configured as a hot node take its registered id, so the
+        # subscription (which dedupes on nodeid) watches that PLC node once
+        by_id = {p.nodeid: r for p, r in zip(plain, regs)}
+        for name in ("n_plc_req_clear", "n_wms_clear_reply_node"):
+            node = getattr(self, name)
+            if node is not None and node.nodeid in by_id:
+                setattr(self, name, by_id[node.nodeid])
+
     def _system_ready(self) -> bool:
         try:
-            ready = bool(self.n_ready.get_value())
-            auto  = bool(self.n_auto.get_value())
-            alarm = bool(self.n_alarm.get_value())
-            return ready and auto and not alarm
+            cache = self._cache
+            if cache is not None and cache.has(self.n_ready) and cache.has(self.n_auto) and cache.has(self.n_alarm):
+                ready, auto, alarm = cache.get(self.n_ready), cache.get(self.n_auto), cache.get(self.n_alarm)
+            else:
+                ready, auto, alarm = self.read_status()
+            return bool(ready) and bool(auto) and not bool(alarm)
         except Exception:
             return False
 
+    def _poll_job_signals(self):
+        """
+        (complete, plc_req_qr, ready, auto, alarm) for the complete-wait loop:
+        from the subscription cache, else in one batched Read request.
+        """
+        cache, nodes = self._cache, self._poll_nodes
+        if cache is not None and all(cache.has(n) for n in nodes):
+            return [cache.get(n) for n in nodes]
+        return self.client.get_values(nodes)
+
     # -------- connect / disconnect --------
-    def connect(self, max_retry=999, delay=2.0):
+    def connect(self, max_retry=60, delay=2.0, max_delay=30.0):
+        if self._exec is None:
+            self._exec = ThreadPoolExecutor(max_workers=2, thread_name_prefix="asrs-db")
         for i in range(max_retry):
             try:
                 self.client = Client(self.endpoint)
@@ -101,8 +339,16 @@ class AsrsMover:
                 self.n_wms_recv_qr = self.client.get_node(self.nodes.wms_receive_basket_qr)
 
                 # (!!!) FIX: ใช้ node จาก opcua_nodes.py (ซึ่งควรจะเป็น None) (!!!)
+                # clear nodes ที่ชี้ node เดียวกับ cmd_complete / wms_complete_reply ไม่ใช่ clear
+                # จริง: ถ้า monitor ตัวนี้ ทุก complete จะถูกนับเป็น clear request และตอบ pulse ซ้ำ
+                nodes = self.nodes
+                has_clear = bool(
+                    nodes.plc_req_wms_clear and nodes.wms_clear_reply
+                    and nodes.plc_req_wms_clear != nodes.cmd_complete
+                    and nodes.wms_clear_reply != nodes.wms_complete_reply
+                )
                 try:
-                    if self.nodes.plc_req_wms_clear:
+                    if has_clear:
                         self.n_plc_req_clear = self.client.get_node(self.nodes.plc_req_wms_clear)
                         self.n_wms_clear_reply_node = self.client.get_node(self.nodes.wms_clear_reply)
                     else:
@@ -112,57 +358,69 @@ class AsrsMover:
                     self.n_plc_req_clear = None
                     self.n_wms_clear_reply_node = None
 
-                try:
-                    self._clear_monitor_stop = False
-                    self._clear_monitor_thread = threading.Thread(target=self._monitor_clear_request, daemon=True)
-                    self._clear_monitor_thread.start()
-                except Exception:
-                    self._clear_monitor_thread = None
-
                 # status
                 self.n_ready = self.client.get_node(self.nodes.asrs_ready)
                 self.n_auto  = self.client.get_node(self.nodes.asrs_auto_mode)
                 self.n_alarm = self.client.get_node(self.nodes.asrs_alarm)
 
-                # encoders
-                self.n_cx = self.client.get_node(self.nodes.crane_x)
-                self.n_cy = self.client.get_node(self.nodes.crane_y)
-                self.n_cz = None
+                self._register_nodes()
+                self._n = [self.n_ack, self.n_complete, self.n_plc_req_qr, self.n_ready, self.n_auto, self.n_alarm]
+                self._poll_nodes = self._n[IDX_COMPLETE:IDX_ALARM + 1]
+                self._subscribe()
+
+                # clear monitor: เฉพาะเมื่อ PLC มี node ขอ clear แยกต่างหาก (ค่า default ชี้ node
+                # เดียวกับ complete -> ไม่ต้องมี thread)
+                self._clear_monitor_thread = None
+                if self.n_plc_req_clear is not None and self.n_wms_clear_reply_node is not None:
+                    self._clear_monitor_stop = False
+                    self._clear_monitor_thread = threading.Thread(target=self._monitor_clear_request, daemon=True)
+                    self._clear_monitor_thread.start()
 
                 # init outputs low
-                for n in (self.n_send, self.n_complete_rpy, self.n_wms_recv_qr):
-                    try: n.set_value(self._dv_bool(False))
-                    except Exception: pass
-                
+                outs = [self.n_send, self.n_complete_rpy, self.n_wms_recv_qr]
                 if self.n_wms_clear_reply_node:
-                    try: self.n_wms_clear_reply_node.set_value(self._dv_bool(False))
-                    except Exception: pass
+                    outs.append(self.n_wms_clear_reply_node)
+                self._write_many([(n, _DV_FALSE) for n in outs])
 
-                print("[Mover] connected")
+                log.info("[Mover] connected")
                 return
             except Exception as e:
-                print(f"[Mover] connect failed ({i+1}): {e}")
-                time.sleep(delay)
-        raise RuntimeError("ASRS mover: cannot connect to OPC UA")
+                log.warning("[Mover] connect failed (%d): %s", i + 1, e)
+                if i + 1 < max_retry:
+                    # exponential backoff + jitter: ไม่ยิง PLC เป็นจังหวะคงที่
+                    time.sleep(min(max_delay, delay * (1.5 ** i)) * (0.5 + random.random()))
+        raise RuntimeError(f"ASRS mover: cannot connect to OPC UA at {self.endpoint} after {max_retry} attempts")
 
     def disconnect(self):
+        self._cache = None
+        if self._sub is not None:
+            try: self._sub.delete()
+            except Exception: pass
+            self._sub = None
+        if self._registered and self.client:
+            try: self.client.unregister_nodes(self._registered)
+            except Exception: pass
+            self._registered = []
         if self.client:
             try: self.client.disconnect()
             except Exception: pass
             self.client = None
         try:
             self._clear_monitor_stop = True
+            self._clear_requested.set()
             if self._clear_monitor_thread and self._clear_monitor_thread.is_alive():
                 self._clear_monitor_thread.join(timeout=1.0)
         except Exception:
             pass
+        # ไม่ค้าง shutdown เพราะงาน DB ที่ยังอยู่ในคิว (connect() ครั้งถัดไปสร้างใหม่)
+        ex, self._exec = self._exec, None
+        if ex is not None:
+            ex.shutdown(wait=False, cancel_futures=True)
             
     def reset_current_command(self):
         try:
             self._clear_cmd_exact()
-            try: self.n_send.set_value(self._dv_bool(False))
-            except Exception: pass
-            
+
             try:
                 self._pulse(self.n_complete_rpy, width_s=0.05)
                 time.sleep(0.1)
@@ -171,108 +429,79 @@ class AsrsMover:
             
             return True
         except Exception as e:
-            print("[ASRS] Reset command error:", e)
+            log.error("[ASRS] Reset command error: %s", e)
             raise Exception(f"Failed to reset command: {str(e)}")
 
-    # -------- encoders --------
-    def _read_crane_position(self):
-        x_col, y_row, z_depth = self._current_xyz
-        rx = ry = None
-        try:
-            rx = int(self.n_cx.get_value())
-            ry = int(self.n_cy.get_value())
-        except Exception:
-            pass
-        self._enc_raw = (rx, ry, None)
-        if rx is not None and ry is not None:
-            x_col, y_row = encoder_to_position(rx, ry)
-            z_depth = 0
-        self._current_xyz = (x_col, y_row, z_depth)
-
     # -------- QR: ตอบเมื่อ PLC ขอ --------
     def _serve_qr_if_requested(self, basket: str, wait_timeout: float = 0.0):
         if wait_timeout > 0:
-            t0 = time.time()
-            while time.time() - t0 < wait_timeout:
-                try:
-                    if bool(self.n_plc_req_qr.get_value()):
-                        break
-                except Exception:
-                    pass
-                time.sleep(0.02)
+            self._wait(self.n_plc_req_qr, True, wait_timeout)
         try:
-            if bool(self.n_plc_req_qr.get_value()):
-                self.n_basket_qr.set_value(self._dv_str(basket or ""))
+            if bool(self._read(self.n_plc_req_qr)):
+                self.n_basket_qr.set_value(self._dv_str(basket) if basket else _DV_EMPTY_STR)
                 time.sleep(0.02)
                 self._pulse(self.n_wms_recv_qr, 0.06)
                 ok = self._wait(self.n_plc_req_qr, False, 2.0)
-                print(f"[QR] replied {basket or '(empty)'} ({'ok' if ok else 'no drop'})")
+                log.info("[QR] replied %s (%s)", basket or "(empty)", "ok" if ok else "no drop")
         except Exception as e:
-            print("[QR] reply error:", e)
+            log.warning("[QR] reply error: %s", e)
 
     # -------- เคลียร์สตริง/แฟล็กหลังจบงาน --------
     def _clear_cmd_exact(self):
-        try:
-            self.n_cmd.set_value(self._dv_str(""))
-        except Exception as e:
-            print("[WARN] clear cmd failed:", e)
-        time.sleep(0.02)
-        try: self.n_basket_qr.set_value(self._dv_str(""))
-        except Exception: pass
-        try: self.n_wms_recv_qr.set_value(self._dv_bool(False))
-        except Exception: pass
-        try: self.n_send.set_value(self._dv_bool(False))
-        except Exception: pass
+        # cmd ต้องอยู่ตัวแรก: server เขียนตามลำดับใน request เดียว
+        ok = self._write_many([
+            (self.n_cmd, _DV_EMPTY_STR),
+            (self.n_basket_qr, _DV_EMPTY_STR),
+            (self.n_wms_recv_qr, _DV_FALSE),
+            (self.n_send, _DV_FALSE),
+        ])
+        if not ok[0]:
+            log.warning("[WARN] clear cmd failed")
 
     def _monitor_clear_request(self):
+        # Only started when both clear nodes exist (see connect()).  The OPC UA
+        # callback cannot issue the reply itself (blocking calls there deadlock
+        # the receive thread), so it wakes this thread via _clear_requested.
         while not self._clear_monitor_stop:
             try:
-                if self.n_plc_req_clear is None or self.n_wms_clear_reply_node is None:
-                    time.sleep(0.25)
-                    continue
-
                 try:
-                    req = bool(self.n_plc_req_clear.get_value())
+                    req = bool(self._read(self.n_plc_req_clear))
                 except Exception:
                     req = False
 
                 if req:
                     try:
                         self._pulse(self.n_wms_clear_reply_node, width_s=0.05)
-                        print("[ASRS] PLC requested clear -> sent WMS clear reply")
+                        log.info("[ASRS] PLC requested clear -> sent WMS clear reply")
                     except Exception as e:
-                        print("[ASRS] Failed to pulse WMS clear reply:", e)
+                        log.warning("[ASRS] Failed to pulse WMS clear reply: %s", e)
 
-                    acquired = self._send_lock.acquire(blocking=False)
+                    # รอจนงานที่กำลังส่งอยู่จบก่อน แล้วค่อยเคลียร์ (แทน flag _pending_clear);
+                    # รอเป็นช่วงสั้น ๆ เพื่อให้ disconnect() หยุด thread นี้ได้
+                    while not self._clear_monitor_stop:
+                        if self._send_lock.acquire(timeout=0.5):
+                            break
+                    else:
+                        return
                     try:
-                        if acquired:
-                            try:
-                                self._clear_cmd_exact()
-                                self._pending_clear = False
-                                print("[ASRS] Cleared WMS data on PLC request")
-                            except Exception as e:
-                                print("[ASRS] Error clearing WMS data:", e)
-                        else:
-                            self._pending_clear = True
+                        # งานที่เพิ่งจบเคลียร์ไปแล้ว ถ้า PLC ปล่อย request แล้วก็ไม่ต้องทำซ้ำ
+                        if bool(self._read(self.n_plc_req_clear)):
+                            self._clear_cmd_exact()
+                            log.info("[ASRS] Cleared WMS data on PLC request")
+                    except Exception as e:
+                        log.warning("[ASRS] Error clearing WMS data: %s", e)
                     finally:
-                        if acquired:
-                            self._send_lock.release()
-                else:
-                    if self._pending_clear:
-                        acquired = self._send_lock.acquire(blocking=False)
-                        if acquired:
-                            try:
-                                self._clear_cmd_exact()
-                                self._pending_clear = False
-                                print("[ASRS] Cleared pending WMS data")
-                            except Exception as e:
-                                print("[ASRS] Error clearing pending WMS data:", e)
-                            finally:
-                                self._send_lock.release()
-
+                        self._send_lock.release()
             except Exception:
-                pass
-            time.sleep(0.15)
+                req = False
+
+            cache = self._cache
+            if cache is not None and cache.has(self.n_plc_req_clear) and not req:
+                # Idle: sleep until the data-change callback reports a new request
+                self._clear_requested.wait(1.0)
+                self._clear_requested.clear()
+            else:
+                time.sleep(0.15)
 
     # -------- (!!!) MODIFICATION: ลบ x, y, z ออกจาก signature (!!!) --------
     def send_job_blocking(self, cmd_str: str, methode: str, row: dict, shelf_id: int):
@@ -285,48 +514,50 @@ class AsrsMover:
         5) รอ complete (เพื่อล้าง Handshake)
         """
         
-        t_start_job = time.time()
+        t_start_job = time.monotonic()
         job_success = False # (!!!) เราจะตั้งเป็น True หลังจากอัปเดต DB (!!!)
-        basket_id = (row.get("basket") or "").strip()
+        # queue rows hold canonical ids (normalized when enqueued)
+        basket_id = BasketId(row.get("basket") or "")
         
         with self._send_lock:
             if not self._system_ready():
-                print("[ASRS] System not ready/auto/alarm; skip")
+                log.info("[ASRS] System not ready/auto/alarm; skip")
                 return False # (!!!) ลบ logging (!!!)
 
-            # เคลียร์สถานะเดิม
-            max_clear_attempts = 3
-            ack_clear = False
-            complete_clear = False
-            for _ in range(max_clear_attempts):
-                ack_clear = self._wait(self.n_ack, False, 2.0)
-                complete_clear = self._wait(self.n_complete, False, 2.0)
-                if ack_clear and complete_clear:
-                    break
+            # เคลียร์สถานะเดิม (ถ้า ack/complete ต่ำอยู่แล้วก็ไม่ต้องทำ handshake)
+            try:
+                ack_clear = not bool(self._read(self.n_ack))
+                complete_clear = not bool(self._read(self.n_complete))
+            except Exception:
+                ack_clear = complete_clear = False
+
+            if not (ack_clear and complete_clear):
                 try:
                     self._clear_cmd_exact()
                     self._pulse(self.n_complete_rpy, width_s=0.05)
-                    time.sleep(0.5)
                 except Exception:
                     pass
-            
+                deadline = time.monotonic() + 2.0
+                ack_clear = self._wait(self.n_ack, False, 2.0)
+                complete_clear = self._wait(self.n_complete, False, max(0.0, deadline - time.monotonic()))
+
             if not (ack_clear and complete_clear):
-                print("[ASRS] Cannot clear previous command state")
+                log.warning("[ASRS] Cannot clear previous command state")
                 return False # (!!!) ลบ logging (!!!)
 
             # 2) ส่งคำสั่ง + รอ ACK
             try:
                 self.n_cmd.set_value(self._dv_str(cmd_str))
-                self.n_send.set_value(self._dv_bool(True))
+                self.n_send.set_value(_DV_TRUE)
             except Exception as e:
-                print(f"[ASRS] CRITICAL: Failed to send command to PLC: {e}")
-                try: self.n_send.set_value(self._dv_bool(False))
+                log.critical("[ASRS] CRITICAL: Failed to send command to PLC: %s", e)
+                try: self.n_send.set_value(_DV_FALSE)
                 except Exception: pass
                 return False # (!!!) ลบ logging (!!!)
 
             if not self._wait(self.n_ack, True, 5.0):
-                self.n_send.set_value(self._dv_bool(False))
-                print("[ASRS] ACK timeout")
+                self.n_send.set_value(_DV_FALSE)
+                log.warning("[ASRS] ACK timeout")
                 return False # (!!!) ลบ logging (!!!)
 
             # ลบออกจากคิวหลัง ACK
@@ -334,26 +565,14 @@ class AsrsMover:
                 if row and "id" in row:
                     self.db.delete_queue_row(methode, int(row["id"]))
             except Exception as e:
-                print("[ASRS] delete_queue_row error:", e)
+                log.error("[ASRS] delete_queue_row error: %s", e)
 
-            self.n_send.set_value(self._dv_bool(False))
+            self.n_send.set_value(_DV_FALSE)
 
             # (!!!) START OF 2.5 WORKAROUND (!!!)
-            # 3) Update DB ทันที (Fire-and-Forget)
-            try:
-                if methode == "PUT":
-                    info = self.db.move_put(shelf_id, basket_id, allow_overwrite_dest=False)
-                    print(f"[ASRS] DB_UPDATE (Sent) -> shelf {shelf_id} <= {basket_id} | cleared_from={info.get('cleared_from')}")
-                else:
-                    self.db.mark_pick(shelf_id)
-                    print(f"[ASRS] DB_UPDATE (Sent) -> shelf {shelf_id} empty")
-                
-                job_success = True # (!!!) ถือว่างานสำเร็จแล้ว ณ จุดนี้ (!!!)
-                
-            except Exception as e:
-                print(f"[ASRS] CRITICAL DB UPDATE ERROR (after ACK): {e}")
-                job_success = False # ถ้า DB ล้มเหลว ถือว่าล้มเหลว
-                # (!!!) ลบ logging (!!!)
+            # 3) Update DB ทันที (Fire-and-Forget) บน worker thread
+            #    ผลลัพธ์ (job_success) มารับตอนท้ายก่อน return
+            db_future = self._exec.submit(self._update_db_after_ack, methode, shelf_id, basket_id)
             # (!!!) END OF 2.5 WORKAROUND (!!!)
 
 
@@ -361,34 +580,41 @@ class AsrsMover:
             self._serve_qr_if_requested(basket_id, wait_timeout=0.5)
 
             # 5) รอ complete (บล็อกจนเสร็จ)
-            t0 = time.time()
+            t0 = time.monotonic()
             complete_timeout = 120.0
             done = False
-            last_status_time = 0
             check_interval = 10.0
-            print(f"[ASRS] Starting operation (now waiting for complete): {methode} {basket_id}")
+            last_status_time = t0 - check_interval  # รายงานครั้งแรกทันที
+            log.info("[ASRS] Starting operation (now waiting for complete): %s %s", methode, basket_id)
             
             system_not_ready_flag = False
+            # ผูกไว้เป็น local ครั้งเดียว (ไม่ต้อง lookup attribute ทุกรอบ)
+            monotonic = time.monotonic
+            poll_signals = self._poll_job_signals
+            n_complete = self.n_complete
             
-            while time.time() - t0 < complete_timeout:
-                current_time = time.time()
+            while monotonic() - t0 < complete_timeout:
+                current_time = monotonic()
+                cache = self._cache
+                seen = cache.version() if cache is not None else None
                 try:
-                    if bool(self.n_complete.get_value()):
+                    complete, req_qr, ready, auto, alarm = poll_signals()
+                    if bool(complete):
                         time.sleep(1.0)
                         
                         try:
                             self._pulse(self.n_complete_rpy, width_s=0.1)
-                            print(f"[ASRS] Operation completed (PLC signal received): {methode} {basket_id}")
+                            log.info("[ASRS] Operation completed (PLC signal received): %s %s", methode, basket_id)
                         except Exception as e:
-                            print(f"[ASRS] Failed to send complete reply: {e}")
+                            log.warning("[ASRS] Failed to send complete reply: %s", e)
                         
                         time.sleep(0.5)
                         
                         try:
                             self._clear_cmd_exact()
-                            print("[ASRS] Command cleared")
+                            log.debug("[ASRS] Command cleared")
                         except Exception as e:
-                            print(f"[ASRS] Failed to clear command: {e}")
+                            log.warning("[ASRS] Failed to clear command: %s", e)
                             
                         done = True
                         break 
@@ -397,62 +623,80 @@ class AsrsMover:
                     if current_time - last_status_time >= check_interval:
                         elapsed = current_time - t0
                         remaining = complete_timeout - elapsed
-                        print(f"[ASRS] Operation in progress: {methode} {basket_id} ({remaining:.0f}s remaining)")
+                        log.debug("[ASRS] Operation in progress: %s %s (%.0fs remaining)", methode, basket_id, remaining)
                         last_status_time = current_time
                         
                 except Exception as e:
-                    print(f"[ASRS] Error reading complete signal: {e}")
+                    log.warning("[ASRS] Error reading complete signal: %s", e)
                     time.sleep(0.1)
                     continue
 
                 # ตอบ QR (ถ้าระหว่างทาง)
-                try:
-                    if bool(self.n_plc_req_qr.get_value()):
-                        self._serve_qr_if_requested(basket_id, wait_timeout=0.0)
-                except Exception:
-                    pass
+                if bool(req_qr):
+                    self._serve_qr_if_requested(basket_id, wait_timeout=0.0)
 
                 # ตรวจสอบสถานะระบบ
-                if not self._system_ready():
+                if not (bool(ready) and bool(auto) and not bool(alarm)):
                     if not system_not_ready_flag:
-                        print("[ASRS] System not ready during operation")
+                        log.warning("[ASRS] System not ready during operation")
                         system_not_ready_flag = True
                     time.sleep(0.5)
                     continue
 
-                time.sleep(0.03)
+                if cache is not None and cache.has(n_complete):
+                    # หลับจนกว่าจะมี data-change (complete / QR / status) หรือถึงรอบรายงานสถานะ
+                    now = monotonic()
+                    next_report = check_interval - (now - last_status_time)
+                    remaining = complete_timeout - (now - t0)
+                    cache.wait_change(seen, max(0.0, min(next_report, remaining, 1.0)))
+                else:
+                    time.sleep(0.03)
 
             
             if not done:
                 reason = "complete_timeout"
                 if system_not_ready_flag:
                     reason = "system_not_ready_timeout"
-                print(f"[ASRS] {reason} - no signal received after", complete_timeout, "seconds")
+                log.warning("[ASRS] %s - no signal received after %s seconds", reason, complete_timeout)
                 # (!!!) ลบ logging (!!!)
             
             # 6) เคลียร์ข้อมูล (ทำเสมอ ไม่ว่าจะ done หรือ timeout)
-            try:
-                self._pulse(self.n_complete_rpy, width_s=0.05)
-            except Exception as e:
-                print(f"[ASRS] Error pulsing complete_rpy (1): {e}")
-
-            self._clear_cmd_exact()
-            self._wait(self.n_complete, False, 5.0)
-            time.sleep(0.15)
+            #    done: ตอบ complete_rpy + clear ไปแล้วใน branch ด้านบน
+            if not done:
+                try:
+                    self._pulse(self.n_complete_rpy, width_s=0.05)
+                except Exception as e:
+                    log.warning("[ASRS] Error pulsing complete_rpy: %s", e)
+                self._clear_cmd_exact()
 
-            try:
-                self._pulse(self.n_complete_rpy, width_s=0.05)
-            except Exception as e:
-                print(f"[ASRS] Error pulsing complete_rpy (2): {e}")
+            if not self._wait(self.n_complete, False, 5.0):
+                # PLC ยังไม่ปล่อย complete: ตอบซ้ำอีกครั้งเดียว
+                try:
+                    self._pulse(self.n_complete_rpy, width_s=0.05)
+                except Exception as e:
+                    log.warning("[ASRS] Error pulsing complete_rpy (retry): %s", e)
 
             self._wait(self.n_ack, False, 5.0)
             self._wait(self.n_ready, True, 3.0)
             
-            t_end_job = time.time()
+            try:
+                job_success = db_future.result(timeout=5.0)
+            except FutureTimeout:
+                # ไม่รอ DB ต่อ: ยกเลิกถ้ายังไม่เริ่ม (ถ้ากำลังรันอยู่จะรันจนจบเอง)
+                cancelled = db_future.cancel()
+                log.critical("[ASRS] DB update after ACK timed out (cancelled=%s)", cancelled)
+                job_success = False
+            except Exception as e:
+                log.critical("[ASRS] CRITICAL DB UPDATE ERROR (after ACK): %r", e)
+                job_success = False
+
+            t_end_job = time.monotonic()
             duration = t_end_job - t_start_job
             kind = methode.lower()
             if kind in self.last_durations:
                 self.last_durations[kind] = duration
+                self._last_seconds[kind] = round(duration, 2)
+                self._notify_status()
             if self.on_cycle_done:
                 try:
                     self.on_cycle_done({
@@ -462,38 +706,47 @@ class AsrsMover:
                         "success": job_success 
                     })
                 except Exception as e:
-                    print(f"[ASRS] Error in on_cycle_done callback: {e}")
+                    log.error("[ASRS] Error in on_cycle_done callback: %s", e)
 
             return job_success
 
+    def _update_db_after_ack(self, methode: str, shelf_id: int, basket_id: str) -> bool:
+        try:
+            if methode == "PUT":
+                info = self.db.move_put(shelf_id, basket_id, allow_overwrite_dest=False)
+                log.info("[ASRS] DB_UPDATE (Sent) -> shelf %s <= %s | cleared_from=%s", shelf_id, basket_id, info.get("cleared_from"))
+            else:
+                self.db.mark_pick(shelf_id)
+                log.info("[ASRS] DB_UPDATE (Sent) -> shelf %s empty", shelf_id)
+            return True # (!!!) ถือว่างานสำเร็จแล้ว ณ จุดนี้ (!!!)
+        except Exception as e:
+            log.critical("[ASRS] CRITICAL DB UPDATE ERROR (after ACK): %s", e)
+            return False # ถ้า DB ล้มเหลว ถือว่าล้มเหลว
+
     # -------- เลือกคิวแบบ FIFO (ไม่มีคะแนน) --------
     def _select_next(self, window_each: int = 20):
-        picks, puts = self.db.next_command_window(limit_each=window_each)
+        picks, puts = self.db.next_usable_command_window(limit_each=window_each)
 
         def first_usable(jobs):
+            unmapped = []
+            found = (None, None)
             for r in jobs:
-                try:
-                    mapping = self.db.get_mapping_for_basket(r["basket"])
-                except Exception as e:
-                    print(f"[ASRS] mapping lookup error for {r.get('basket')}: {e}")
-                    continue
-                if not mapping:
-                    print(f"[ASRS] No mapping found for basket {r.get('basket')}, skipping.")
-                    try: self.db.delete_queue_row(r["methode"], int(r["id"]))
-                    except Exception: pass
+                if r["shelf_id"] is None or r["sx"] is None:
+                    log.warning("[ASRS] No mapping found for basket %s, skipping.", r.get("basket"))
+                    unmapped.append(r["id"])
                     continue
 
-                shelf_id = mapping[0]
-                try:
-                    if self.db.shelf_can_use(shelf_id):
-                        return (r, mapping)
-                except Exception as e:
-                    print(f"[ASRS] shelf_can_use error shelf {shelf_id}: {e}")
-                    continue
-            return (None, None)
+                if r["can_use"]:
+                    found = (r, (int(r["shelf_id"]), int(r["sx"]), int(r["sy"]), int(r["sz"])))
+                    break
+            # ลบแถวที่ไม่มี mapping ทีเดียว (1 round-trip แทนทีละแถว)
+            if unmapped:
+                try: self.db.delete_queue_rows(jobs[0]["methode"], unmapped)
+                except Exception: pass
+            return found
 
-        p_job, p_map = first_usable([dict(r, methode="PICK") for r in picks])
-        q_job, q_map = first_usable([dict(r, methode="PUT") for r in puts])
+        p_job, p_map = first_usable(picks)
+        q_job, q_map = first_usable(puts)
 
 
         if p_job and not q_job:
@@ -510,41 +763,66 @@ class AsrsMover:
                 return ("PICK", p_job, p_map)
         return (None, None, None)
 
-    # -------- สร้างสตริงคำสั่ง 20 ตัวอักษร --------
-    @staticmethod
-    def _id4(n: int) -> str:
-        s = str(n); return ("0000" + s)[-4:]
+    # -------- รอคิวใหม่ (LISTEN/NOTIFY) --------
+    def _open_queue_listener(self):
+        try:
+            self._queue_listener = self.db.open_queue_listener()
+            self._listen_backoff = 1.0
+        except Exception as e:
+            log.warning("[ASRS] queue LISTEN unavailable, polling (retry in %.0fs): %s", self._listen_backoff, e)
+            self._queue_listener = None
+            self._listen_retry_at = time.monotonic() + self._listen_backoff
+            self._listen_backoff = min(30.0, self._listen_backoff * 2)
+
+    def _close_queue_listener(self):
+        conn, self._queue_listener = self._queue_listener, None
+        if conn is not None:
+            try: conn.close()
+            except Exception: pass
 
-    @staticmethod
-    def _d2(n: int) -> str:
-        s = str(n); return s if len(s) > 1 else ("0" + s)
+    def _wait_for_queue(self, timeout_s: float = 1.0):
+        """Block until an enqueue NOTIFY arrives (or timeout_s passes)."""
+        conn = self._queue_listener
+        if conn is None and time.monotonic() >= self._listen_retry_at:
+            self._open_queue_listener()
+            conn = self._queue_listener
+        if conn is None:
+            time.sleep(0.1)
+            return
+        try:
+            if select.select([conn], [], [], timeout_s)[0]:
+                conn.poll()
+                conn.notifies.clear()
+        except Exception as e:
+            log.warning("[ASRS] queue listener lost, reconnecting: %s", e)
+            self._close_queue_listener()
 
     # -------- main loop (บล็อกทีละงาน) --------
     def loop(self, stop_flag):
         get_stop = getattr(stop_flag, "is_set", None)
         checker = get_stop if callable(get_stop) else (stop_flag if callable(stop_flag) else (lambda: False))
 
+        self._open_queue_listener()
         current_id = 0
         while not checker():
             try:
-                self._read_crane_position()
-
                 methode, row, mapping = self._select_next(window_each=20)
                 if not row:
-                    time.sleep(0.1)
+                    self._wait_for_queue(1.0)
                     continue
                 
                 basket_id = row["basket"]
                 shelf_id, x, y, z = mapping
 
-                # 20-chars: iiii M XX YY Z bbbbbbbbbb
-                M = "0" if methode == "PUT" else "1"
-                X = self._d2(int(x))
-                Y = self._d2(int(y))
-                Z = str(int(z))
-                cmd_str = f"{self._id4(current_id)}{M}{X}{Y}{Z}{basket_id}"
+                # 20-chars: iiii M XX YY Z bbbbbbbbbb (id วนที่ 4 หลักสุดท้าย)
+                cmd_str = _CMD_FMT % (
+                    current_id % 10000,
+                    "0" if methode == "PUT" else "1",
+                    int(x), int(y), int(z),
+                    basket_id,
+                )
                 if len(cmd_str) != 20:
-                    print("[ERR] CMD length not 20:", cmd_str)
+                    log.error("[ERR] CMD length not 20: %s", cmd_str)
                     time.sleep(0.1)
                     continue
 
@@ -561,9 +839,10 @@ class AsrsMover:
                     }
                     current_id += 1
                 else:
-                    print("[ASRS] Job failed (Critical Error), waiting 2s before next attempt.")
+                    log.warning("[ASRS] Job failed (Critical Error), waiting 2s before next attempt.")
                     time.sleep(2.0)
 
             except Exception as e:
-                print("[ASRS loop error]", e)
-                time.sleep(0.2)
\ No newline at end of file
+                log.error("[ASRS loop error] %s", e)
+                time.sleep(0.2)
+        self._close_queue_listener()
\ No newline at end of file
@@ -1,8 +1,12 @@
 import os
+from functools import lru_cache
+from types import MappingProxyType
 from urllib.parse import urlparse
 from dotenv import load_dotenv
 
+@lru_cache(maxsize=1)
 def load():
+    # Parsed once per process; the result is read-only (call reload() to re-read .env)
     # Load environment variables from .env file
     env_path = os.path.join(os.path.dirname(__file__), "..", ".env")
     load_dotenv(dotenv_path=env_path)
@@ -24,5 +28,14 @@ def load():
         "DB_NAME": os.getenv("DB_NAME", "asrs"),
         "API_HOST": os.getenv("API_HOST", "0.0.0.0"),
         "API_PORT": int(os.getenv("API_PORT", "8001")),
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "INFO").strip(),
     }
-    return cfg
+    return MappingProxyType(cfg)
+
+def reload():
+    """
+    Drop the cached config and build it again from the environment.
+    Variables already present in os.environ win over .env (load_dotenv default).
+    """
+    load.cache_clear()
+    return load()
@@ -1,20 +1,95 @@
 # Thread-safe PostgreSQL database access layer
 import os
+import threading
+import time
+import asyncpg
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 from contextlib import contextmanager
 try:
-    from .utils import normalize_basket_id
+    from .utils import BasketId
 except ImportError:
-    from utils import normalize_basket_id
+    from utils import BasketId
+
+# shelf_can_use results are reused for this long (seconds)
+SHELF_USABLE_TTL_S = 0.5
+# basket -> shelf mappings change only on re-import, reuse them longer
+MAPPING_TTL_S = 30.0
+# bound on cached lookups before the cache is simply dropped
+LOOKUP_CACHE_MAX = 4096
+
+_MISS = object()
+
+# LISTEN/NOTIFY channel signalled whenever a queue_put / queue_pick row is added
+# (by the asrs_queue_notify trigger, so inserts from any client wake the mover)
+QUEUE_CHANNEL = "asrs_queue"
+
+# Hot queries, PREPAREd once on every pooled connection (name -> SQL).
+# Only statements the service runs per scan/job belong here.
+PREPARED_STATEMENTS = {
+    # Pg.try_enqueue_put: $1 basket
+    "try_enqueue_put": (
+        "WITH m AS ("
+        " SELECT b.shelf_id, s.x_column AS x, s.y_row AS y, s.z_depth AS z,"
+        " s.basket_id AS current_basket, s.active, s.can_use, s.shelf_id IS NOT NULL AS shelf_found"
+        " FROM basket_data b LEFT JOIN shelf_data s ON s.shelf_id = b.shelf_id"
+        " WHERE b.basket_id = $1::text"
+        "), occ AS ("
+        " SELECT shelf_id FROM shelf_data WHERE basket_id = $1::text LIMIT 1"
+        "), st AS ("
+        " SELECT CASE"
+        " WHEN m.shelf_id IS NULL THEN 'UNKNOWN_BASKET'"
+        " WHEN EXISTS (SELECT 1 FROM occ) THEN 'ALREADY_STORED'"
+        " WHEN NOT m.shelf_found THEN 'SHELF_MISSING'"
+        " WHEN m.active THEN 'SHELF_ACTIVE'"
+        " WHEN COALESCE(m.current_basket, '') <> '' THEN 'SHELF_OCCUPIED'"
+        " WHEN NOT COALESCE(m.can_use, FALSE) THEN 'SHELF_UNUSABLE'"
+        " WHEN EXISTS (SELECT 1 FROM queue_put WHERE basket = $1::text) THEN 'DUPLICATE'"
+        " ELSE 'OK' END AS status"
+        " FROM (SELECT 1) one LEFT JOIN m ON TRUE"
+        "), ins AS ("
+        " INSERT INTO queue_put (basket, x, y, z)"
+        " SELECT $1::text, m.x, m.y, m.z FROM m, st WHERE st.status = 'OK'"
+        " RETURNING id"
+        ") "
+        "SELECT st.status, m.shelf_id, m.current_basket,"
+        " (SELECT shelf_id FROM occ) AS occupied_shelf,"
+        " (SELECT id FROM ins) AS queue_id"
+        " FROM st LEFT JOIN m ON TRUE"
+    ),
+}
+
+class _PreparingPool(ThreadedConnectionPool):
+    """ThreadedConnectionPool that PREPAREs PREPARED_STATEMENTS on each new connection."""
+
+    def _connect(self, key=None):
+        conn = super()._connect(key)
+        conn.autocommit = True
+        with conn.cursor() as c:
+            for name, sql in PREPARED_STATEMENTS.items():
+                c.execute(f"PREPARE {name} AS {sql}")
+        return conn
 
 class Pg:
     """
-    Thread-safe PostgreSQL connection manager that creates new connections for each operation
-    to prevent concurrency issues between QR listener and mover threads.
+    Thread-safe PostgreSQL access backed by a connection pool.  Every operation
+    borrows its own connection from the pool (and returns it afterwards), so the
+    QR listener, mover and API threads never share a connection but also do not
+    pay a TCP connect + auth handshake per query.
     """
 
-    def __init__(self):
+    # Databases whose schema was already checked in this process (host, port, dbname)
+    _schema_ready: set = set()
+    _schema_lock = threading.Lock()
+
+    def __init__(self, minconn: int | None = None, maxconn: int | None = None):
+        # Read-through cache for shelf/basket metadata lookups:
+        # key -> (shelf version, monotonic timestamp, ttl or None, value).
+        # Any shelf write bumps the version, which invalidates every entry.
+        self._lookup_cache: dict[tuple, tuple] = {}
+        self._lookup_lock = threading.Lock()
+        self._shelf_version = 0
         # Store database connection parameters from environment variables
         self.conn_params = {
             'host': os.getenv('DB_HOST'),
@@ -23,75 +98,122 @@ class Pg:
             'password': os.getenv('DB_PASS'),
             'dbname': os.getenv('DB_NAME'),
         }
-        # Ensure operation_history table exists
-        self._ensure_operation_history_table()
+        if minconn is None:
+            minconn = int(os.getenv('DB_POOL_MIN') or 2)
+        if maxconn is None:
+            maxconn = int(os.getenv('DB_POOL_MAX') or 16)
+        self._pool = _PreparingPool(minconn, maxconn, **self.conn_params)
+        # Ensure operation_history table and lookup indexes exist
+        self._ensure_schema()
+
+    def close(self):
+        """Close every pooled connection (call once on shutdown)."""
+        try:
+            self._pool.closeall()
+        except Exception:
+            pass
+
+    def _release(self, conn, broken: bool = False):
+        # Dead connections (server restart, network drop) are closed instead of
+        # going back to the pool, so the next caller gets a fresh one
+        self._pool.putconn(conn, close=broken or bool(conn.closed))
 
     @contextmanager
-    def cursor(self):
-        """Creates a new database connection and cursor for thread-safe operations"""
-        conn = None
+    def cursor(self, cursor_factory=RealDictCursor):
+        """Borrows a pooled connection in autocommit mode and yields a cursor"""
+        conn = self._pool.getconn()
         cur = None
+        broken = False
         try:
-            # Create new connection with autocommit for immediate execution
-            conn = psycopg2.connect(**self.conn_params)
+            # Autocommit for immediate execution
             conn.autocommit = True
-            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur = conn.cursor(cursor_factory=cursor_factory)
             yield cur
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
         finally:
-            # Close the cursor and connection to free resources.  If either
-            # object is None or already closed, ignore any exception.
+            # Close the cursor and hand the connection back to the pool
             if cur is not None:
                 try:
                     cur.close()
                 except Exception:
                     pass
-            if conn is not None:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
+            self._release(conn, broken)
+
+    def cursor_tuple(self):
+        """Like cursor() but rows are plain tuples (no per-row dict), for point reads"""
+        return self.cursor(cursor_factory=None)
 
     # --- (!!!) ฟังก์ชันที่เพิ่มเข้ามาใหม่ (!!!) ---
     @contextmanager
     def transaction(self):
-        """Creates a new database connection and cursor for a transaction"""
-        conn = None
+        """Borrows a pooled connection and yields (conn, cursor) for a transaction"""
+        conn = self._pool.getconn()
         cur = None
+        broken = False
         try:
-            # Create new connection, *no* autocommit
-            conn = psycopg2.connect(**self.conn_params)
+            # *no* autocommit
             conn.autocommit = False  # Ensure transaction handling
             cur = conn.cursor(cursor_factory=RealDictCursor)
             yield conn, cur
             # If no exception, commit the transaction
             conn.commit()
         except Exception as e:
+            broken = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
             # If exception, rollback
-            if conn:
-                try:
-                    conn.rollback()
-                except Exception as rb_e:
-                    print(f"[DB] Error during rollback: {rb_e}")
+            try:
+                conn.rollback()
+            except Exception as rb_e:
+                broken = True
+                print(f"[DB] Error during rollback: {rb_e}")
             # Re-raise the original exception
             raise e
         finally:
-            # Close the cursor and connection
+            # Close the cursor and hand the connection back to the pool
             if cur is not None:
                 try:
                     cur.close()
                 except Exception:
                     pass
-            if conn is not None:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
+            self._release(conn, broken)
     # --- (!!!) จบส่วนที่เพิ่มเข้ามาใหม่ (!!!) ---
 
 
+    # --- Lookup cache ---
+    def _cache_get(self, key):
+        with self._lookup_lock:
+            hit = self._lookup_cache.get(key)
+            version = self._shelf_version
+        if hit is None or hit[0] != version:
+            return _MISS
+        if hit[2] is not None and time.monotonic() - hit[1] >= hit[2]:
+            return _MISS
+        return hit[3]
+
+    def _cache_put(self, key, value, ttl, version):
+        # `version` is read before the query: a write that lands meanwhile
+        # bumps past it, so the stale value is never served
+        with self._lookup_lock:
+            if len(self._lookup_cache) >= LOOKUP_CACHE_MAX:
+                self._lookup_cache.clear()
+            self._lookup_cache[key] = (version, time.monotonic(), ttl, value)
+
+    def _bump_shelf_version(self):
+        with self._lookup_lock:
+            self._shelf_version += 1
+
     # --- Mapping / Coordinates ---
-    def get_mapping_for_basket(self, basket_id: str):
-        with self.cursor() as c:
+    # Not used by the service itself (scans go through try_enqueue_put, the API
+    # through AsyncPg); kept for scripts and ad-hoc use.
+    def get_mapping_for_basket(self, basket_id: BasketId):
+        bid = basket_id
+        key = ("mapping", bid)
+        hit = self._cache_get(key)
+        if hit is not _MISS:
+            return hit
+        version = self._shelf_version
+        with self.cursor_tuple() as c:
             c.execute(
                 """
                 SELECT b.shelf_id, s.x_column AS x, s.y_row AS y, s.z_depth AS z
@@ -99,24 +221,29 @@ class Pg:
                 JOIN shelf_data  s ON s.shelf_id = b.shelf_id
                 WHERE b.basket_id = %s
                 """,
-                (basket_id.strip(),),
+                (bid,),
             )
             row = c.fetchone()
-            return (int(row["shelf_id"]), int(row["x"]), int(row["y"]), int(row["z"])) if row else None
-
-    def get_coords_for_basket(self, basket_id: str):
+        if not row:
+            # not cached: a basket imported a moment later must resolve at once
+            return None
+        mapping = (int(row[0]), int(row[1]), int(row[2]), int(row[3]))
+        self._cache_put(key, mapping, MAPPING_TTL_S, version)
+        return mapping
+
+    def get_coords_for_basket(self, basket_id: BasketId):
         m = self.get_mapping_for_basket(basket_id)
         return (m[1], m[2], m[3]) if m else None
 
-    def get_shelf_of_basket(self, basket_id: str):
-        with self.cursor() as c:
-            c.execute("SELECT shelf_id FROM shelf_data WHERE basket_id = %s", (basket_id.strip(),))
+    def get_shelf_of_basket(self, basket_id: BasketId):
+        with self.cursor_tuple() as c:
+            c.execute("SELECT shelf_id FROM shelf_data WHERE basket_id = %s", (basket_id,))
             row = c.fetchone()
-            return int(row["shelf_id"]) if row else None
+            return int(row[0]) if row else None
 
     # --- Queues ---
-    def enqueue_put(self, basket: str, x: int, y: int, z: int):
-        basket_norm = normalize_basket_id(basket) if basket else None
+    def enqueue_put(self, basket: BasketId, x: int, y: int, z: int):
+        basket_norm = basket or None
         with self.transaction() as (conn, c):
             # ไม่แตะ shelf_data ตรงนี้แล้ว
             c.execute(
@@ -124,9 +251,10 @@ class Pg:
                 (basket_norm, int(x), int(y), int(z)),
             )
 
-    def enqueue_pick(self, basket: str, x: int, y: int, z: int) -> int:
-        basket_norm = normalize_basket_id(basket) if basket else None
-        with self.transaction() as (conn, c):
+    def enqueue_pick(self, basket: BasketId, x: int, y: int, z: int) -> int:
+        basket_norm = basket or None
+        # Single INSERT ... RETURNING: autocommit is enough, no explicit transaction
+        with self.cursor() as c:
             # ไม่แตะ shelf_data ตรงนี้แล้ว
             c.execute(
                 "INSERT INTO queue_pick (basket, x, y, z) VALUES (%s, %s, %s, %s) RETURNING id",
@@ -134,13 +262,78 @@ class Pg:
             )
             return int(c.fetchone()["id"])
 
+    # Outcomes of try_enqueue_put (checked in this order)
+    ENQ_OK = "OK"
+    ENQ_UNKNOWN_BASKET = "UNKNOWN_BASKET"
+    ENQ_ALREADY_STORED = "ALREADY_STORED"
+    ENQ_SHELF_MISSING = "SHELF_MISSING"
+    ENQ_SHELF_ACTIVE = "SHELF_ACTIVE"
+    ENQ_SHELF_OCCUPIED = "SHELF_OCCUPIED"
+    ENQ_SHELF_UNUSABLE = "SHELF_UNUSABLE"
+    ENQ_DUPLICATE = "DUPLICATE"
+
+    def try_enqueue_put(self, basket: BasketId) -> dict:
+        """
+        Validate a scanned basket and queue its PUT in one statement (one
+        round-trip): mapping, already stored, target shelf missing / active /
+        occupied / unusable, then pending duplicate.  The INSERT happens only
+        when every check passes, in the same snapshot.
+
+        Returns a dict with `status` (one of the ENQ_* values), `shelf_id`,
+        `occupied_shelf` (where the basket already is), `current_basket`
+        (what occupies the target shelf) and `queue_id` (when queued).
+        """
+        with self.cursor() as c:
+            c.execute("EXECUTE try_enqueue_put(%s)", (basket,))
+            return dict(c.fetchone())
+
+    def open_queue_listener(self):
+        """
+        Dedicated autocommit connection LISTENing on QUEUE_CHANNEL.  Not taken
+        from the pool: it stays open for the life of the mover loop.
+        """
+        conn = psycopg2.connect(**self.conn_params)
+        conn.autocommit = True
+        with conn.cursor() as c:
+            c.execute(f"LISTEN {QUEUE_CHANNEL}")
+        return conn
+
 
-    def next_command_window(self, limit_each=20):
+    def next_usable_command_window(self, limit_each=20):
+        """
+        Oldest `limit_each` rows of each queue, already joined with the basket
+        mapping and the shelf's can_use flag, in a single round-trip.
+
+        Every row carries `methode` ('PICK' / 'PUT'), the queue columns
+        (id, basket, x, y, z, created_at) and `shelf_id`, `sx`, `sy`, `sz`,
+        `can_use`.  Unmapped baskets are kept (shelf_id is NULL) so the caller
+        can drop them from the queue.
+
+        Returns:
+            (picks, puts): two lists ordered by created_at.
+        """
         with self.cursor() as c:
-            c.execute("SELECT * FROM queue_pick ORDER BY created_at ASC LIMIT %s", (limit_each,))
-            picks = c.fetchall()
-            c.execute("SELECT * FROM queue_put  ORDER BY created_at ASC LIMIT %s", (limit_each,))
-            puts  = c.fetchall()
+            c.execute(
+                """
+                (SELECT 'PICK' AS methode, q.id, q.basket, q.x, q.y, q.z, q.created_at,
+                        b.shelf_id, s.x_column AS sx, s.y_row AS sy, s.z_depth AS sz, s.can_use
+                 FROM queue_pick q
+                 LEFT JOIN basket_data b ON b.basket_id = btrim(q.basket)
+                 LEFT JOIN shelf_data  s ON s.shelf_id = b.shelf_id
+                 ORDER BY q.created_at ASC LIMIT %s)
+                UNION ALL
+                (SELECT 'PUT' AS methode, q.id, q.basket, q.x, q.y, q.z, q.created_at,
+                        b.shelf_id, s.x_column AS sx, s.y_row AS sy, s.z_depth AS sz, s.can_use
+                 FROM queue_put q
+                 LEFT JOIN basket_data b ON b.basket_id = btrim(q.basket)
+                 LEFT JOIN shelf_data  s ON s.shelf_id = b.shelf_id
+                 ORDER BY q.created_at ASC LIMIT %s)
+                """,
+                (limit_each, limit_each),
+            )
+            rows = c.fetchall()
+        picks = [r for r in rows if r["methode"] == "PICK"]
+        puts  = [r for r in rows if r["methode"] == "PUT"]
         return picks, puts
 
     def delete_queue_row(self, methode: str, row_id: int):
@@ -148,59 +341,61 @@ class Pg:
         with self.cursor() as c:
             c.execute(f"DELETE FROM {table} WHERE id = %s", (int(row_id),))
 
+    def delete_queue_rows(self, methode: str, row_ids) -> None:
+        """Delete several queue rows in one round-trip (instead of one DELETE per row)"""
+        ids = [int(i) for i in row_ids]
+        if not ids:
+            return
+        table = "queue_pick" if methode == "PICK" else "queue_put"
+        with self.cursor() as c:
+            c.execute(f"DELETE FROM {table} WHERE id = ANY(%s)", (ids,))
+
     # --- Occupancy updates ---
-    def mark_shelf_occupied(self, shelf_id: int, basket_id: str):
+    def mark_shelf_occupied(self, shelf_id: int, basket_id: BasketId):
+        basket = basket_id or None
         with self.cursor() as c:
-            # Update shelf status
-            c.execute(
-                """
-                UPDATE shelf_data 
-                SET basket_id = %s, 
-                    active = TRUE, 
-                    lastupdate_time = NOW() AT TIME ZONE 'Asia/Bangkok'
-                WHERE shelf_id = %s
-                """,
-                (basket_id.strip() if basket_id else None, int(shelf_id)),
-            )
-            # Add operation history
+            # Update shelf status + add operation history in one statement
             c.execute(
                 """
+                WITH upd AS (
+                    UPDATE shelf_data 
+                    SET basket_id = %s, 
+                        active = TRUE, 
+                        lastupdate_time = NOW() AT TIME ZONE 'Asia/Bangkok'
+                    WHERE shelf_id = %s
+                )
                 INSERT INTO operation_history 
                 (shelf_id, basket_id, operation_type, status, timestamp)
                 VALUES (%s, %s, 'PUT', 'success', NOW() AT TIME ZONE 'Asia/Bangkok')
                 """,
-                (int(shelf_id), basket_id.strip() if basket_id else None)
+                (basket, int(shelf_id), int(shelf_id), basket),
             )
+        self._bump_shelf_version()
 
     def mark_shelf_empty(self, shelf_id: int):
         with self.cursor() as c:
-            # Get current basket_id before updating
-            c.execute("SELECT basket_id FROM shelf_data WHERE shelf_id = %s", (int(shelf_id),))
-            row = c.fetchone()
-            old_basket_id = row["basket_id"] if row else None
-
-            # Update shelf status
+            # One statement: every CTE sees the same snapshot, so `old` still
+            # holds the basket_id from before the UPDATE; history only if there was one
             c.execute(
                 """
-                UPDATE shelf_data 
-                SET basket_id = NULL, 
-                    active = FALSE, 
-                    lastupdate_time = NOW() AT TIME ZONE 'Asia/Bangkok'
-                WHERE shelf_id = %s
+                WITH old AS (
+                    SELECT shelf_id, basket_id FROM shelf_data WHERE shelf_id = %s
+                ), upd AS (
+                    UPDATE shelf_data 
+                    SET basket_id = NULL, 
+                        active = FALSE, 
+                        lastupdate_time = NOW() AT TIME ZONE 'Asia/Bangkok'
+                    WHERE shelf_id = %s
+                )
+                INSERT INTO operation_history 
+                (shelf_id, basket_id, operation_type, status, timestamp)
+                SELECT shelf_id, basket_id, 'PICK', 'success', NOW() AT TIME ZONE 'Asia/Bangkok'
+                FROM old
+                WHERE basket_id <> ''
                 """,
-                (int(shelf_id),),
+                (int(shelf_id), int(shelf_id)),
             )
-
-            # Add operation history
-            if old_basket_id:
-                c.execute(
-                    """
-                    INSERT INTO operation_history 
-                    (shelf_id, basket_id, operation_type, status, timestamp)
-                    VALUES (%s, %s, 'PICK', 'success', NOW() AT TIME ZONE 'Asia/Bangkok')
-                    """,
-                    (int(shelf_id), old_basket_id)
-                )
+        self._bump_shelf_version()
 
     # --- Queue management ---
     def clear_all_queues(self) -> None:
@@ -213,18 +408,35 @@ class Pg:
             None
         """
         with self.cursor() as c:
-            # Delete all rows from queue_pick and queue_put tables
-            c.execute("DELETE FROM queue_pick")
-            c.execute("DELETE FROM queue_put")
+            # Empty both queues in one statement. Ids are NOT restarted: the mover
+            # may still delete an in-flight row by id after ACK
+            try:
+                c.execute("TRUNCATE queue_pick, queue_put")
+            except psycopg2.Error as e:
+                # e.g. a foreign key references a queue table, or no TRUNCATE privilege
+                print(f"[DB] TRUNCATE queues failed ({e}); deleting instead")
+                c.execute("WITH a AS (DELETE FROM queue_pick) DELETE FROM queue_put")
+        self.invalidate_shelf_cache()
 
     # --- Helpers ---
+    # get_zone_by_xy / shelf_can_use / shelf_can_use_by_xyz / has_pending_put have
+    # no callers in the service (try_enqueue_put and next_usable_command_window do
+    # these checks in SQL); kept for scripts and ad-hoc use.
     def get_zone_by_xy(self, x:int, y:int, z:int=0) -> int | None:
-        with self.cursor() as c:
+        # zone is static shelf layout: cached until the next shelf write
+        key = ("zone", int(x), int(y), int(z))
+        hit = self._cache_get(key)
+        if hit is not _MISS:
+            return hit
+        version = self._shelf_version
+        with self.cursor_tuple() as c:
             c.execute("""SELECT zone FROM shelf_data
                          WHERE x_column=%s AND y_row=%s AND z_depth=%s LIMIT 1""",
                       (int(x),int(y),int(z)))
             r = c.fetchone()
-            return int(r["zone"]) if r else None
+        zone = int(r[0]) if r else None
+        self._cache_put(key, zone, None, version)
+        return zone
 
     # --- Shelf availability ---
     def shelf_can_use(self, shelf_id: int) -> bool:
@@ -236,15 +448,33 @@ class Pg:
         Args:
             shelf_id: The primary key of the shelf to check.
 
+        Results are cached per shelf for SHELF_USABLE_TTL_S.
+
         Returns:
             bool: True if the shelf is usable, False if it is marked
                 unusable or does not exist.
         """
-        with self.cursor() as c:
-            c.execute("SELECT can_use FROM shelf_data WHERE shelf_id = %s", (int(shelf_id),))
+        sid = int(shelf_id)
+        key = ("can_use", sid)
+        hit = self._cache_get(key)
+        if hit is not _MISS:
+            return hit
+
+        version = self._shelf_version
+        with self.cursor_tuple() as c:
+            c.execute("SELECT can_use FROM shelf_data WHERE shelf_id = %s", (sid,))
             row = c.fetchone()
             # If the shelf does not exist or can_use is None, treat as unusable
-            return bool(row["can_use"]) if row and row.get("can_use") is not None else False
+            usable = bool(row[0]) if row and row[0] is not None else False
+
+        self._cache_put(key, usable, SHELF_USABLE_TTL_S, version)
+        return usable
+
+    def invalidate_shelf_cache(self) -> None:
+        """Drop cached shelf lookups (call after changing shelf_data outside Pg)."""
+        with self._lookup_lock:
+            self._lookup_cache.clear()
+            self._shelf_version += 1
 
     def shelf_can_use_by_xyz(self, x: int, y: int, z: int = 0) -> bool:
         """
@@ -259,16 +489,23 @@ class Pg:
         Returns:
             bool: True if the shelf can be used, False otherwise.
         """
-        with self.cursor() as c:
+        key = ("can_use_xyz", int(x), int(y), int(z))
+        hit = self._cache_get(key)
+        if hit is not _MISS:
+            return hit
+        version = self._shelf_version
+        with self.cursor_tuple() as c:
             c.execute(
                 "SELECT can_use FROM shelf_data WHERE x_column = %s AND y_row = %s AND z_depth = %s LIMIT 1",
                 (int(x), int(y), int(z)),
             )
             row = c.fetchone()
-            return bool(row["can_use"]) if row and row.get("can_use") is not None else False
+            usable = bool(row[0]) if row and row[0] is not None else False
+        self._cache_put(key, usable, SHELF_USABLE_TTL_S, version)
+        return usable
 
     # --- Queue inspection ---
-    def has_pending_put(self, basket: str) -> bool:
+    def has_pending_put(self, basket: BasketId) -> bool:
         """
         Check if there is already a pending PUT command for the given basket in the
         queue_put table.  Returns True if an entry exists, False otherwise.
@@ -279,15 +516,64 @@ class Pg:
         Returns:
             bool: True if the basket is already in the PUT queue, False otherwise.
         """
-        with self.cursor() as c:
-            c.execute(
-                "SELECT 1 FROM queue_put WHERE basket = %s LIMIT 1",
-                (basket.strip(),),
-            )
+        with self.cursor_tuple() as c:
+            c.execute("SELECT 1 FROM queue_put WHERE basket = %s LIMIT 1", (basket,))
             return c.fetchone() is not None
 
     # --- Shelf occupancy ---
-    def _ensure_operation_history_table(self):
+    # Indexes for the hot point lookups (INCLUDE columns -> index-only scans)
+    _INDEXES = (
+        "CREATE INDEX IF NOT EXISTS ix_shelf_xyz ON shelf_data (x_column, y_row, z_depth) INCLUDE (zone, can_use, shelf_id)",
+        "CREATE INDEX IF NOT EXISTS ix_shelf_basket ON shelf_data (basket_id)",
+        "CREATE INDEX IF NOT EXISTS ix_basket_data_basket ON basket_data (basket_id) INCLUDE (shelf_id)",
+        "CREATE INDEX IF NOT EXISTS ix_queue_put_basket ON queue_put (basket)",
+        "CREATE INDEX IF NOT EXISTS ix_queue_put_created ON queue_put (created_at)",
+        "CREATE INDEX IF NOT EXISTS ix_queue_pick_created ON queue_pick (created_at)",
+    )
+
+    # NOTIFY QUEUE_CHANNEL for rows inserted into either queue (sent on commit;
+    # identical notifications in one transaction are folded into one)
+    _QUEUE_NOTIFY_DDL = f"""
+        CREATE OR REPLACE FUNCTION asrs_queue_notify() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('{QUEUE_CHANNEL}', '');
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS asrs_queue_put_notify ON queue_put;
+        CREATE TRIGGER asrs_queue_put_notify AFTER INSERT ON queue_put
+            FOR EACH ROW EXECUTE FUNCTION asrs_queue_notify();
+        DROP TRIGGER IF EXISTS asrs_queue_pick_notify ON queue_pick;
+        CREATE TRIGGER asrs_queue_pick_notify AFTER INSERT ON queue_pick
+            FOR EACH ROW EXECUTE FUNCTION asrs_queue_notify();
+    """
+
+    def _ensure_schema(self):
+        """Create operation_history table, lookup indexes and the queue NOTIFY
+        triggers if they don't exist.
+        Runs once per database per process; later Pg() instances skip the DDL."""
+        key = (self.conn_params['host'], self.conn_params['port'], self.conn_params['dbname'])
+        with Pg._schema_lock:
+            if key in Pg._schema_ready:
+                return
+            ok = self._ensure_operation_history_table()
+            with self.cursor() as c:
+                for sql in self._INDEXES:
+                    try:
+                        c.execute(sql)
+                    except Exception as e:
+                        ok = False
+                        print(f"[DB] Warning: Could not create index ({sql.split(' ON ')[0].split()[-1]}): {e}")
+            try:
+                with self.transaction() as (conn, c):
+                    c.execute(self._QUEUE_NOTIFY_DDL)
+            except Exception as e:
+                ok = False
+                print(f"[DB] Warning: Could not create queue NOTIFY triggers: {e}")
+            if ok:
+                Pg._schema_ready.add(key)
+
+    def _ensure_operation_history_table(self) -> bool:
         """Create operation_history table if it doesn't exist"""
         with self.cursor() as c:
             try:
@@ -303,8 +589,10 @@ class Pg:
                     )
                 """)
                 print("[DB] Operation history table ready")
+                return True
             except Exception as e:
                 print(f"[DB] Warning: Could not create operation_history table: {e}")
+                return False
 
     def get_basket_on_shelf(self, shelf_id: int) -> str | None:
         """
@@ -318,14 +606,14 @@ class Pg:
             Optional[str]: The basket ID occupying the shelf, or None if the
             shelf is empty or missing.
         """
-        with self.cursor() as c:
+        with self.cursor_tuple() as c:
             c.execute(
                 "SELECT basket_id FROM shelf_data WHERE shelf_id = %s",
                 (int(shelf_id),),
             )
             row = c.fetchone()
             # If no record or basket_id is None, return None
-            return str(row["basket_id"]) if row and row.get("basket_id") else None
+            return str(row[0]) if row and row[0] else None
         # --- Occupancy updates at FINAL completion ---
     
         # --- Occupancy updates at FINAL completion ---
@@ -345,8 +633,9 @@ class Pg:
                 """,
                 (int(shelf_id),),
             )
+        self._bump_shelf_version()
 
-    def move_put(self, shelf_id: int, basket_id: str, *, allow_overwrite_dest: bool = False):
+    def move_put(self, shelf_id: int, basket_id: BasketId, *, allow_overwrite_dest: bool = False):
         """
         PUT (with move-protection) — อัปเดตตอนจบงานจริง:
         1) เคลียร์ตำแหน่งเดิมของ basket_id (ถ้ามี)
@@ -355,12 +644,14 @@ class Pg:
 
         คืนค่า dict: {"cleared_from": [old_shelf_ids], "placed_to": shelf_id}
         """
-        bid = normalize_basket_id(basket_id) if basket_id else None
+        bid = basket_id or None
         if bid is None:
             raise ValueError("basket_id is required for move_put")
 
         with self.transaction() as (conn, c):
-            # 1) เคลียร์ตำแหน่งเดิมของตะกร้านี้ (ถ้ามี)
+            # ทั้ง 3 ขั้นใน statement เดียว (round-trip เดียว):
+            # cleared = เคลียร์ตำแหน่งเดิม (ยกเว้นปลายทาง: แถวเดียวกันถูก UPDATE ซ้ำใน statement เดียวไม่ได้)
+            # placed  = วางลงปลายทางถ้าว่าง / เป็นตะกร้าเดิม / allow_overwrite_dest
             c.execute(
                 """
                 WITH cleared AS (
@@ -368,52 +659,118 @@ class Pg:
                        SET basket_id = NULL,
                            active     = FALSE,
                            lastupdate_time = (NOW() AT TIME ZONE 'Asia/Bangkok')
-                     WHERE basket_id = %s
+                     WHERE basket_id = %(bid)s AND shelf_id <> %(sid)s
+                 RETURNING shelf_id
+                ), dest AS (
+                    SELECT basket_id FROM shelf_data WHERE shelf_id = %(sid)s
+                ), placed AS (
+                    UPDATE shelf_data
+                       SET basket_id = %(bid)s,
+                           active     = TRUE,
+                           lastupdate_time = (NOW() AT TIME ZONE 'Asia/Bangkok')
+                     WHERE shelf_id = %(sid)s
+                       AND (basket_id IS NULL OR basket_id = %(bid)s OR %(overwrite)s)
                  RETURNING shelf_id
                 )
-                SELECT array_agg(shelf_id) AS cleared_from FROM cleared
+                SELECT (SELECT array_agg(shelf_id) FROM cleared) AS cleared_from,
+                       (SELECT shelf_id FROM placed)            AS placed_to,
+                       EXISTS (SELECT 1 FROM dest)              AS dest_exists,
+                       (SELECT basket_id FROM dest)             AS dest_basket
                 """,
-                (bid,),
-            )
-            cleared_from = (c.fetchone() or {}).get("cleared_from") or []
-
-            # 2) ตรวจปลายทาง + ล็อคแถว
-            c.execute(
-                "SELECT basket_id, active FROM shelf_data WHERE shelf_id = %s FOR UPDATE",
-                (int(shelf_id),),
+                {"bid": bid, "sid": int(shelf_id), "overwrite": bool(allow_overwrite_dest)},
             )
             row = c.fetchone()
-            if not row:
-                raise ValueError(f"shelf_id {shelf_id} ไม่มีอยู่ใน shelf_data")
+            cleared_from = row["cleared_from"] or []
 
-            dest_has_other = row["basket_id"] is not None and row["basket_id"] != bid
-            if dest_has_other and not allow_overwrite_dest:
+            # ยกเว้นใน transaction -> rollback รวมถึงการเคลียร์ตำแหน่งเดิม
+            if row["placed_to"] is None:
+                if not row["dest_exists"]:
+                    raise ValueError(f"shelf_id {shelf_id} ไม่มีอยู่ใน shelf_data")
                 raise ValueError(
-                    f"ปลายทาง shelf_id {shelf_id} มีตะกร้า {row['basket_id']} อยู่แล้ว (allow_overwrite_dest=False)"
+                    f"ปลายทาง shelf_id {shelf_id} มีตะกร้า {row['dest_basket']} อยู่แล้ว (allow_overwrite_dest=False)"
                 )
 
-            if dest_has_other and allow_overwrite_dest:
-                c.execute(
-                    """
-                    UPDATE shelf_data
-                       SET basket_id = NULL,
-                           active     = FALSE,
-                           lastupdate_time = (NOW() AT TIME ZONE 'Asia/Bangkok')
-                     WHERE shelf_id = %s
-                    """,
-                    (int(shelf_id),),
-                )
+        self._bump_shelf_version()
+        return {"cleared_from": cleared_from, "placed_to": int(shelf_id)}
 
-            # 3) วางตะกร้าลงปลายทาง
-            c.execute(
+
+class AsyncPg:
+    """
+    asyncpg connection pool for the FastAPI handlers.  The pool is bound to the
+    event loop it was created on, so `open()` must be awaited from the API's
+    startup hook rather than from `AsrsServiceApp.__init__`.
+    """
+
+    def __init__(self):
+        self.pool = None
+
+    async def open(self, min_size: int = 2, max_size: int = 10):
+        self.pool = await asyncpg.create_pool(
+            host=os.getenv('DB_HOST'),
+            port=int(os.getenv('DB_PORT') or 5432),
+            user=os.getenv('DB_USER'),
+            password=os.getenv('DB_PASS'),
+            database=os.getenv('DB_NAME'),
+            min_size=min_size,
+            max_size=max_size,
+            # Recycle idle connections after 30 s instead of holding them open
+            max_inactive_connection_lifetime=30.0,
+            # asyncpg prepares every query and reuses the plan per connection;
+            # keep room for all hot statements so none get evicted
+            statement_cache_size=1024,
+        )
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    # --- Mapping / Coordinates ---
+    async def get_mapping_for_basket(self, basket_id: BasketId):
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow(
                 """
-                UPDATE shelf_data
-                   SET basket_id = %s,
-                       active     = TRUE,
-                       lastupdate_time = (NOW() AT TIME ZONE 'Asia/Bangkok')
-                 WHERE shelf_id = %s
+                SELECT b.shelf_id, s.x_column AS x, s.y_row AS y, s.z_depth AS z
+                FROM basket_data b
+                JOIN shelf_data  s ON s.shelf_id = b.shelf_id
+                WHERE b.basket_id = $1
                 """,
-                (bid, int(shelf_id)),
+                basket_id,
             )
+        return (int(row["shelf_id"]), int(row["x"]), int(row["y"]), int(row["z"])) if row else None
 
-        return {"cleared_from": cleared_from, "placed_to": int(shelf_id)}
\ No newline at end of file
+    async def get_mapping_and_usability(self, basket_id: BasketId):
+        """
+        Mapping and shelf `can_use` flag in one round-trip.  Returns
+        (shelf_id, x, y, z, can_use) or None if the basket is not mapped.
+        """
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow(
+                """
+                SELECT b.shelf_id, s.x_column AS x, s.y_row AS y, s.z_depth AS z, s.can_use
+                FROM basket_data b
+                JOIN shelf_data  s ON s.shelf_id = b.shelf_id
+                WHERE b.basket_id = $1
+                """,
+                basket_id,
+            )
+        if not row:
+            return None
+        return (int(row["shelf_id"]), int(row["x"]), int(row["y"]), int(row["z"]), bool(row["can_use"]))
+
+    async def get_shelf_of_basket(self, basket_id: BasketId):
+        async with self.pool.acquire() as conn:
+            shelf_id = await conn.fetchval(
+                "SELECT shelf_id FROM shelf_data WHERE basket_id = $1", basket_id
+            )
+        return int(shelf_id) if shelf_id is not None else None
+
+    # --- Queues ---
+    async def enqueue_pick(self, basket: BasketId, x: int, y: int, z: int) -> int:
+        basket_norm = basket or None
+        async with self.pool.acquire() as conn:
+            qid = await conn.fetchval(
+                "INSERT INTO queue_pick (basket, x, y, z) VALUES ($1, $2, $3, $4) RETURNING id",
+                basket_norm, int(x), int(y), int(z),
+            )
+        return int(qid)
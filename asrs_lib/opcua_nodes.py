@@ -1,6 +1,6 @@
 from dataclasses import dataclass
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class OpcUaNodes:
     # QR read + flag from PLC
     basket_qr: str = "ns=4;i=2"
@@ -14,7 +14,9 @@ class OpcUaNodes:
     wms_send_cmd: str = "ns=4;i=15"     # WMS -> PLC strobe
     plc_receive_cmd: str = "ns=4;i=16"  # PLC ack
 
-    # No longer used in the simplified command flow; set to None
+    # No longer used in the simplified command flow; set to None.
+    # The defaults alias cmd_complete / wms_complete_reply, so the mover treats
+    # them as absent (no clear monitor) unless they point at distinct nodes.
     plc_req_wms_clear: str = "ns=4;i=12"
     wms_clear_reply: str = "ns=4;i=13"
 
@@ -6,7 +6,8 @@ Features:
 - Reads a data file (defaults to ./basket_data.csv)
 - Normalizes column names (mapping 'code'->'basket_id' and 'shelf'->'shelf_id')
 - Sorts by basket id ascending (numeric-aware if ids include digits)
-- Inserts rows using ON CONFLICT to upsert shelf assignments
+- Upserts rows in batches (multi-row INSERT ... ON CONFLICT) in one transaction
+- CSV imports are streamed in chunks (COPY into a staging table), so memory stays flat
 
 Usage examples:
   # from workspace root (PowerShell)
@@ -19,47 +20,44 @@ Usage examples:
 from __future__ import annotations
 
 import re
+import io
+import math
+import csv
 import argparse
-from typing import Optional
 
 import pandas as pd
+from psycopg2.extras import execute_values
+
+try:
+    import python_calamine  # noqa: F401  (Rust XLSX reader, much faster than openpyxl)
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = "openpyxl"
 
 # ensure .env is loaded so Pg picks up env vars
 from . import config
 from .db import Pg
 
+# trailing digits of a basket id (B00000001 -> 00000001), compiled once
+_TRAILING_DIGITS = re.compile(r"(\d+)$")
 
-def _numeric_key_for_basket(bid: Optional[str]):
-    """Return a sort key for basket ids. If the id contains trailing digits (e.g. B00000001)
-    the numeric portion is used so ordering is numeric; otherwise fall back to the raw string.
-    """
-    if bid is None:
-        return (1, "")
-    s = str(bid).strip()
-    m = re.search(r"(\d+)$", s)
-    if m:
-        try:
-            return (0, int(m.group(1)), s)
-        except Exception:
-            return (0, s)
-    return (0, s)
 
+_ID_COLUMNS = ("code", "basket_id")
+_SHELF_COLUMNS = ("shelf", "shelf_id")
 
-def import_excel_to_db(file_path: str, dry_run: bool = False) -> dict:
-    # ensure environment variables from .env are loaded
-    config.load()
 
-    # --- CHANGED: Handle .csv or .xlsx file ---
-    if file_path.endswith(".csv"):
-        print(f"Reading CSV: {file_path}")
-        df = pd.read_csv(file_path, dtype=str)
-    elif file_path.endswith(".xlsx"):
-        print(f"Reading Excel: {file_path}")
-        df = pd.read_excel(file_path, dtype=str, engine="openpyxl")
-    else:
-        raise ValueError("File must be .csv or .xlsx")
-    # --- END CHANGE ---
+def _read_table(file_path: str, reader, **kwargs):
+    """Read only the basket/shelf columns; basket ids as text (keeps leading zeros),
+    shelf left to the parser's own typed (C-level) conversion.
+    Extra kwargs (e.g. chunksize) go to the final read."""
+    names = {c: str(c).strip().lower() for c in reader(file_path, nrows=0).columns}
+    keep = [c for c, n in names.items() if n in _ID_COLUMNS + _SHELF_COLUMNS]
+    ids = {c: str for c in keep if names[c] in _ID_COLUMNS}
+    return reader(file_path, usecols=keep or None, dtype=ids, **kwargs)
 
+
+def _normalize_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Rename to basket_id/shelf_id, keep only those, strip text and blank -> None."""
     # normalize column names to simple lower-case names
     df.columns = [str(c).strip().lower() for c in df.columns]
 
@@ -80,22 +78,71 @@ def import_excel_to_db(file_path: str, dry_run: bool = False) -> dict:
 
     # Keep only relevant columns
     if shelf_col:
-        df = df[["basket_id", "shelf_id"]]
+        df = df[["basket_id", "shelf_id"]].copy()
     else:
-        df = df[["basket_id"]]
+        df = df[["basket_id"]].copy()
         df["shelf_id"] = None
 
-    # Strip whitespace and normalize empty -> None
-    df["basket_id"] = df["basket_id"].astype(str).str.strip()
-    df["shelf_id"] = df["shelf_id"].where(df["shelf_id"].notna(), None)
-    # Handle empty strings like "" for shelf_id and convert them to None
-    df["shelf_id"] = df["shelf_id"].apply(lambda x: None if pd.isna(x) or str(x).strip() == "" else x)
+    # Strip whitespace and normalize empty -> None (column-wise, no per-row apply)
+    df["basket_id"] = df["basket_id"].fillna("").astype(str).str.strip()
+    if df["shelf_id"].dtype == object:
+        # text column (stray non-numeric values): strip, blank -> None; numeric columns are used as parsed
+        shelf_txt = df["shelf_id"].fillna("").astype(str).str.strip()
+        df["shelf_id"] = shelf_txt.where(shelf_txt != "", None)
+    return df
+
+
+def _frame_rows(df: pd.DataFrame) -> tuple[list[tuple], int]:
+    """(basket_id, shelf_id) rows from a normalized frame; returns (rows, skipped)."""
+    # Drop rows without a basket id
+    valid = df["basket_id"] != ""
+    skipped = int((~valid).sum())
+    if skipped:
+        print(f"[WARN] Skipping {skipped} row(s) with empty basket_id")
+    baskets = df.loc[valid, "basket_id"]
+    shelves = df.loc[valid, "shelf_id"]
+
+    # Coerce shelf to int in one pass; "516.0" -> 516, unparseable -> NULL
+    shelf_num = pd.to_numeric(shelves, errors="coerce").replace([float("inf"), float("-inf")], float("nan"))
+    bad = shelves.notna() & shelf_num.isna()
+    for basket_id, shelf in zip(baskets[bad].tolist(), shelves[bad].tolist()):
+        print(f"[WARN] Could not parse shelf '{shelf}' for basket '{basket_id}'. Setting to NULL.")
+
+    rows = list(zip(
+        baskets.tolist(),
+        [None if math.isnan(v) else int(v) for v in shelf_num.tolist()],
+    ))
+    return rows, skipped
+
+
+def import_excel_to_db(file_path: str, dry_run: bool = False) -> dict:
+    # ensure environment variables from .env are loaded
+    config.load()
+
+    # --- CHANGED: Handle .csv or .xlsx file ---
+    if file_path.endswith(".csv"):
+        if not dry_run:
+            # real imports stream the CSV; memory stays O(CSV_CHUNK_ROWS)
+            return _import_csv_chunked(file_path)
+        print(f"Reading CSV: {file_path}")
+        df = _read_table(file_path, pd.read_csv)
+    elif file_path.endswith(".xlsx"):
+        print(f"Reading Excel: {file_path} ({EXCEL_ENGINE})")
+        df = _read_table(file_path, lambda f, **kw: pd.read_excel(f, engine=EXCEL_ENGINE, **kw))
+    else:
+        raise ValueError("File must be .csv or .xlsx")
+    # --- END CHANGE ---
 
+    df = _normalize_frame(df)
 
-    # Sort using numeric-aware key
-    df["_sort_key"] = df["basket_id"].apply(_numeric_key_for_basket)
-    df = df.sort_values(by="_sort_key")
-    df = df.drop(columns=["_sort_key"])  # cleanup
+    # Numeric-aware sort on the trailing digits of basket_id:
+    # ids with trailing digits first, by that number, then the rest by string
+    num = pd.to_numeric(df["basket_id"].str.extract(_TRAILING_DIGITS.pattern, expand=False), errors="coerce")
+    df = (
+        df.assign(_nostr=num.isna(), _nk=num.fillna(0))
+          .sort_values(by=["_nostr", "_nk", "basket_id"], kind="mergesort")
+          .drop(columns=["_nostr", "_nk"])  # cleanup
+    )
 
     total = len(df)
     print(f"Rows to import: {total}")
@@ -106,47 +153,125 @@ def import_excel_to_db(file_path: str, dry_run: bool = False) -> dict:
         print("-----------------------------------------")
         return {"inserted": 0, "updated": 0, "total": total, "status": "dry_run"}
 
+    rows, errors = _frame_rows(df)
+    inserted, failed = _upsert_rows(Pg(), rows)
+    errors += failed
+
+    print(f"Completed. rows processed: {total}, successful upserts: {inserted}, errors: {errors}")
+    return {"inserted": inserted, "total": total, "errors": errors}
+
+
+# CSV imports are parsed and staged this many rows at a time
+CSV_CHUNK_ROWS = 50_000
+
+
+def _import_csv_chunked(file_path: str) -> dict:
+    """
+    Stream a CSV into basket_data without loading it whole: every chunk is
+    normalized and COPY'd into the staging table, and a single
+    INSERT ... SELECT upserts everything at the end, in one transaction.
+    Upsert order does not change the result, so the numeric sort is skipped.
+    If the batch is rejected, fall back to per-chunk upserts (_upsert_rows).
+    """
+    print(f"Reading CSV: {file_path} (streaming, {CSV_CHUNK_ROWS} rows per chunk)")
     pg = Pg()
-    inserted = 0
-    updated = 0 # Note: script doesn't track updates, only upserts
-    errors = 0
-    
-    upsert_sql = (
-        "INSERT INTO basket_data (basket_id, shelf_id) VALUES (%s, %s) "
-        "ON CONFLICT (basket_id) DO UPDATE SET shelf_id = EXCLUDED.shelf_id"
-    )
 
-    with pg.cursor() as cur:
-        for _, row in df.iterrows():
-            basket_id = row["basket_id"].strip() if row["basket_id"] else None
-            shelf = row["shelf_id"]
-
-            if basket_id is None or basket_id == "":
-                print("[WARN] Skipping row with empty basket_id")
-                errors += 1
-                continue
-
-            # try to coerce shelf to int if possible
-            if shelf is not None and str(shelf).strip() != "":
-                try:
-                    # Convert via float first to handle values like "516.0"
-                    shelf_val = int(float(str(shelf).strip()))
-                except Exception:
-                    # keep raw value and let DB raise if invalid (or print warning)
-                    print(f"[WARN] Could not parse shelf '{shelf}' for basket '{basket_id}'. Setting to NULL.")
-                    shelf_val = None # Safer to set to NULL if parsing fails
+    def chunks():
+        for chunk in _read_table(file_path, pd.read_csv, chunksize=CSV_CHUNK_ROWS):
+            yield len(chunk), *_frame_rows(_normalize_frame(chunk))
+
+    total = errors = 0
+    try:
+        with pg.transaction() as (conn, cur):
+            cur.execute(_STAGE_SQL)
+            for n, rows, skipped in chunks():
+                total += n
+                errors += skipped
+                _copy_stage(cur, rows)
+            cur.execute(_STAGE_UPSERT_SQL)
+            inserted = cur.rowcount
+    except RuntimeError:
+        raise  # missing basket_id column: nothing to retry
+    except Exception as e:
+        print(f"[WARN] Streaming upsert failed ({e}); retrying chunk by chunk")
+        total = errors = inserted = 0
+        for n, rows, skipped in chunks():
+            ok, failed = _upsert_rows(pg, rows)
+            total += n
+            inserted += ok
+            errors += skipped + failed
+
+    print(f"Completed. rows processed: {total}, successful upserts: {inserted}, errors: {errors}")
+    return {"inserted": inserted, "total": total, "errors": errors}
+
+
+UPSERT_SQL = (
+    "INSERT INTO basket_data (basket_id, shelf_id) VALUES %s "
+    "ON CONFLICT (basket_id) DO UPDATE SET shelf_id = EXCLUDED.shelf_id"
+)
+
+# From this many rows on, stream through COPY into a staging table instead
+COPY_THRESHOLD = 5000
+
+# seq keeps file order, so the last row per basket wins (as in _upsert_rows)
+_STAGE_SQL = "CREATE TEMP TABLE basket_stage (seq bigserial, basket_id text, shelf_id int) ON COMMIT DROP"
+_STAGE_UPSERT_SQL = (
+    "INSERT INTO basket_data (basket_id, shelf_id) "
+    "SELECT DISTINCT ON (basket_id) basket_id, shelf_id FROM basket_stage "
+    "ORDER BY basket_id, seq DESC "
+    "ON CONFLICT (basket_id) DO UPDATE SET shelf_id = EXCLUDED.shelf_id"
+)
+
+
+def _copy_stage(cur, rows: list[tuple]) -> None:
+    """COPY (basket_id, shelf_id) rows into the basket_stage temp table."""
+    buf = io.StringIO()
+    csv.writer(buf, lineterminator="\n").writerows(rows)  # None -> empty unquoted field -> NULL
+    buf.seek(0)
+    cur.copy_expert("COPY basket_stage (basket_id, shelf_id) FROM STDIN WITH (FORMAT csv)", buf)
+
+
+def _copy_upsert(cur, rows: list[tuple]) -> None:
+    """COPY rows into a temp table, then upsert basket_data from it in one statement."""
+    cur.execute(_STAGE_SQL)
+    _copy_stage(cur, rows)
+    cur.execute(_STAGE_UPSERT_SQL)
+
+
+def _upsert_rows(pg: Pg, rows: list[tuple]) -> tuple[int, int]:
+    """Upsert (basket_id, shelf_id) rows; returns (upserted, failed).
+
+    All rows go in one transaction: multi-row INSERTs (execute_values), or
+    for large files COPY into a staging table + one INSERT ... SELECT.
+    If that batch is rejected (e.g. a shelf_id that violates a constraint),
+    fall back to row-by-row upserts so one bad row only fails itself.
+    """
+    # A single INSERT ... ON CONFLICT cannot touch the same key twice:
+    # keep the last value per basket, as the old row-by-row loop did
+    rows = list(dict(rows).items())
+    if not rows:
+        return 0, 0
+
+    try:
+        with pg.transaction() as (conn, cur):
+            if len(rows) >= COPY_THRESHOLD:
+                _copy_upsert(cur, rows)
             else:
-                shelf_val = None
+                execute_values(cur, UPSERT_SQL, rows, page_size=1000)
+        return len(rows), 0
+    except Exception as e:
+        print(f"[WARN] Batch upsert failed ({e}); retrying row by row")
 
+    upserted = failed = 0
+    with pg.cursor() as cur:
+        for basket_id, shelf_val in rows:
             try:
-                cur.execute(upsert_sql, (basket_id, shelf_val))
-                inserted += 1 # This counts successful upserts (inserts or updates)
+                execute_values(cur, UPSERT_SQL, [(basket_id, shelf_val)])
+                upserted += 1
             except Exception as e:
                 print(f"[ERROR] Failed to upsert {basket_id}: {e}")
-                errors += 1
-
-    print(f"Completed. rows processed: {total}, successful upserts: {inserted}, errors: {errors}")
-    return {"inserted": inserted, "total": total, "errors": errors}
+                failed += 1
+    return upserted, failed
 
 
 def main():
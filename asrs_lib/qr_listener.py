@@ -1,6 +1,109 @@
 import time
+import random
+import logging
+import threading
 from opcua import Client, ua
 from .opcua_nodes import OpcUaNodes
+from .db import Pg
+from .utils import to_basket_id
+
+log = logging.getLogger("asrs.qr")
+
+# Subscription tuning: publish every 200 ms, but let the server sample as fast
+# as it can (0) and queue up to 8 samples per item, so a flag pulse shorter
+# than the publishing interval still arrives as its own True/False samples
+QR_PUBLISH_MS = 200
+QR_SAMPLING_MS = 0
+QR_QUEUE_SIZE = 8
+
+# Pg.try_enqueue_put status -> (log level, message, send error ACK).
+# Messages are formatted from the result row plus "basket".
+_ENQ_OUTCOMES = {
+    Pg.ENQ_OK: (logging.INFO, "[PUT-ENQ] Added %(basket)s to queue for shelf %(shelf_id)s", False),
+    Pg.ENQ_UNKNOWN_BASKET: (
+        logging.ERROR,
+        "[ERROR] ⚠️ Basket '%(basket)s' not registered in system database\n"
+        "[INFO] Please add basket data to the system before using",
+        True,  # ส่งสัญญาณแจ้งเตือนไปยัง PLC
+    ),
+    Pg.ENQ_SHELF_MISSING: (logging.ERROR, "[ERROR] Shelf %(shelf_id)s not found in database", False),
+    Pg.ENQ_SHELF_ACTIVE: (logging.ERROR, "[ERROR] Shelf %(shelf_id)s is currently active and cannot be used", False),
+    Pg.ENQ_SHELF_OCCUPIED: (logging.ERROR, "[ERROR] Shelf %(shelf_id)s is occupied by %(current_basket)s", False),
+    Pg.ENQ_SHELF_UNUSABLE: (logging.WARNING, "This shelf can't use now.", False),
+    Pg.ENQ_DUPLICATE: (logging.INFO, "[PUT-ENQ] duplicate ignored for %(basket)s", False),
+}
+# ALREADY_STORED depends on where the basket is: on its own shelf or elsewhere
+_ENQ_STORED_HERE = (logging.INFO, "[INFO] Basket %(basket)s is already stored on shelf %(shelf_id)s", False)
+_ENQ_STORED_ELSEWHERE = (
+    logging.ERROR,
+    "[ERROR] Basket %(basket)s is recorded on shelf %(occupied_shelf)s but mapped to %(shelf_id)s",
+    False,
+)
+
+# Prebuilt ACK values (no Variant/DataValue allocation per pulse).
+# DO NOT set dv.ServerTimestamp or dv.SourceTimestamp
+_DV_TRUE = ua.DataValue(ua.Variant(True, ua.VariantType.Boolean))
+_DV_FALSE = ua.DataValue(ua.Variant(False, ua.VariantType.Boolean))
+
+
+def _write_params(node, dv):
+    """A ready-to-send single-node Write request body (reused for every write)."""
+    wv = ua.WriteValue()
+    wv.NodeId = node.nodeid
+    wv.AttributeId = ua.AttributeIds.Value
+    wv.Value = dv
+    params = ua.WriteParameters()
+    params.NodesToWrite.append(wv)
+    return params
+
+
+def _monitor_request(node, client_handle):
+    """
+    Value monitor with QR_SAMPLING_MS / QR_QUEUE_SIZE.  Client handles only
+    need to be unique within the subscription, which holds nothing else.
+    """
+    rv = ua.ReadValueId()
+    rv.NodeId = node.nodeid
+    rv.AttributeId = ua.AttributeIds.Value
+    params = ua.MonitoringParameters()
+    params.ClientHandle = client_handle
+    params.SamplingInterval = QR_SAMPLING_MS
+    params.QueueSize = QR_QUEUE_SIZE
+    params.DiscardOldest = True
+    mir = ua.MonitoredItemCreateRequest()
+    mir.ItemToMonitor = rv
+    mir.MonitoringMode = ua.MonitoringMode.Reporting
+    mir.RequestedParameters = params
+    return mir
+
+
+class _QrSubHandler:
+    """
+    Data-change handler for the QR flag / QR code / ASRS ready nodes.  Runs on
+    the OPC UA receive thread, so it only records the value and wakes loop();
+    the reads/ACK writes of the handshake happen on the listener thread.
+    """
+
+    def __init__(self, flag_node):
+        self.values = {}
+        self.changed = threading.Event()
+        self._flag_id = flag_node.nodeid
+        # every True sample of the flag (queued samples included): a pulse that
+        # is already low again by the time loop() looks is still seen
+        self.flag_rises = 0
+
+    def has(self, node) -> bool:
+        return node is not None and node.nodeid in self.values
+
+    def get(self, node):
+        return self.values[node.nodeid]
+
+    def datachange_notification(self, node, val, data):
+        self.values[node.nodeid] = val
+        if val and node.nodeid == self._flag_id:
+            self.flag_rises += 1
+        self.changed.set()
+
 
 class QrListener:
     def __init__(self, endpoint: str, nodes: OpcUaNodes, db, interval=0.5):
@@ -10,22 +113,25 @@ class QrListener:
         self.db = db
         # QR acknowledgment node for PLC handshake
         self.n_ack_basket = None
+        # prebuilt Write requests for the ACK edges: (high, low)
+        self._ack_writes = None
+        # optional ASRS ready node; always bound (None = not configured) by start()
+        self.n_asrs_ready = None
         self.client = None
         self._last_flag = None
         self._last_qr = None
         self._stop = False
+        # data-change subscription (None -> poll every `interval`)
+        self._sub = None
+        self._handler = None
+        # polling fallback: flag, QR (and ready) read in one request per loop
+        self._poll_nodes = []
+        self._polled_ready = None
+        self._seen_rises = 0
+        # monotonic deadline of the flag-drop debounce window
+        self._debounce_until = 0.0
 
-    # (!!!) START OF FIX (!!!)
-    # เพิ่ม Helper function ตัวเดียวกับใน asrs_mover.py
-    @staticmethod
-    def _dv_bool(v: bool):
-        """Helper to create a DataValue without timestamps."""
-        dv = ua.DataValue(ua.Variant(v, ua.VariantType.Boolean))
-        # DO NOT set dv.ServerTimestamp or dv.SourceTimestamp
-        return dv
-    # (!!!) END OF FIX (!!!)
-
-    def start(self, max_retry=999, delay=2.0):
+    def start(self, max_retry=999, delay=2.0, max_delay=30.0):
         for i in range(max_retry):
             try:
                 self.client = Client(self.endpoint)
@@ -40,6 +146,10 @@ class QrListener:
                         self.n_ack_basket = self.client.get_node(ack_id)
                 except Exception:
                     self.n_ack_basket = None
+                self._ack_writes = None
+                if self.n_ack_basket is not None:
+                    self._ack_writes = (_write_params(self.n_ack_basket, _DV_TRUE),
+                                        _write_params(self.n_ack_basket, _DV_FALSE))
                 # optional ASRS status node to avoid enqueue while busy
                 try:
                     asrs_ready_id = getattr(self.nodes, 'asrs_ready', None)
@@ -49,15 +159,95 @@ class QrListener:
                         self.n_asrs_ready = None
                 except Exception:
                     self.n_asrs_ready = None
-                print("[QR] connected")
+                self._poll_nodes = [n for n in (self.n_flag, self.n_qr, self.n_asrs_ready) if n is not None]
+                self._subscribe()
+                log.info("[QR] connected")
                 return
             except Exception as e:
-                print(f"[QR] connect failed ({i+1}): {e}")
-                time.sleep(delay)
-        raise RuntimeError("QR listener: cannot connect to OPC UA")
+                log.warning("[QR] connect failed (%d): %s", i + 1, e)
+                # drop the half-open session before the next attempt
+                if self.client is not None:
+                    try: self.client.disconnect()
+                    except Exception: pass
+                    self.client = None
+                if self._stop:
+                    break
+                if i + 1 < max_retry:
+                    # exponential backoff + jitter (เหมือน mover): ไม่ยิง PLC เป็นจังหวะคงที่
+                    time.sleep(min(max_delay, delay * (1.5 ** i)) * (0.5 + random.random()))
+        raise RuntimeError(f"QR listener: cannot connect to OPC UA at {self.endpoint}")
+
+    def _subscribe(self):
+        """Watch flag/QR/ready by data-change instead of reading them every `interval`."""
+        handler = _QrSubHandler(self.n_flag)
+        watched = [n for n in (self.n_flag, self.n_qr, self.n_asrs_ready) if n is not None]
+        try:
+            self._sub = self.client.create_subscription(QR_PUBLISH_MS, handler)
+            # subscribe_data_change() would sample at the publishing interval:
+            # build the requests with explicit sampling interval / queue size instead
+            items = [_monitor_request(node, handle) for handle, node in enumerate(watched, 1)]
+            for result in self._sub.create_monitored_items(items):
+                if isinstance(result, ua.StatusCode):
+                    result.check()
+            self._seen_rises = 0
+            self._handler = handler
+        except Exception as e:
+            log.warning("[QR] subscription failed, falling back to polling: %s", e)
+            if self._sub is not None:
+                try: self._sub.delete()
+                except Exception: pass
+            self._sub = None
+            self._handler = None
+
+    def _read_signals(self):
+        """
+        (flag, qr_raw).  Subscribed: flag from the cache and qr_raw None (read it
+        directly when needed).  Polling: flag, QR and ready in one get_values().
+        """
+        h = self._handler
+        if h is not None and h.has(self.n_flag):
+            # a rise seen since the last call counts as high even if it already dropped
+            rises = h.flag_rises
+            rose, self._seen_rises = rises != self._seen_rises, rises
+            return bool(h.get(self.n_flag)) or rose, None
+        values = self.client.get_values(self._poll_nodes)
+        if len(values) > 2:
+            self._polled_ready = bool(values[2])
+        return bool(values[0]), values[1]
+
+    def _asrs_ready(self) -> bool:
+        node = self.n_asrs_ready
+        if node is None:
+            return True
+        h = self._handler
+        if h is not None and h.has(node):
+            return bool(h.get(node))
+        if self._polled_ready is not None:
+            return self._polled_ready  # read with this loop's flag/QR
+        return bool(node.get_value())
+
+    def _wait_next(self, timeout_s=None):
+        """
+        Sleep until the next evaluation: a data-change, or `interval` when
+        polling; never longer than `timeout_s` when given.
+        """
+        h = self._handler
+        if h is not None:
+            # waking on any change is enough; the values are read from the handler
+            h.changed.wait(1.0 if timeout_s is None else timeout_s)
+            h.changed.clear()
+        else:
+            time.sleep(self.interval if timeout_s is None else min(timeout_s, self.interval))
 
     def stop(self):
         self._stop = True
+        if self._handler is not None:
+            self._handler.changed.set()  # wake loop() so it sees _stop
+        if self._sub is not None:
+            try: self._sub.delete()
+            except Exception: pass
+            self._sub = None
+        self._handler = None
         if self.client:
             try: self.client.disconnect()
             except: pass
@@ -69,138 +259,87 @@ class QrListener:
         """
         self._last_qr = None
         self._last_flag = None
-        print("[QR] State reset complete")
+        log.info("[QR] State reset complete")
         
+    def _pulse_ack(self, width_s: float):
+        """
+        ACK pulse: True, hold `width_s`, False.  Kept as two writes on purpose:
+        the PLC must see the high level for at least one scan, so both edges
+        cannot go out in one request.  The low write is attempted even if the
+        hold is interrupted, so the ACK never stays latched high.
+        """
+        high, low = self._ack_writes
+        write = self.client.uaclient.write  # no per-edge WriteValue/WriteParameters build
+        try:
+            write(high)[0].check()
+            time.sleep(width_s)
+        finally:
+            write(low)[0].check()
+
     def _send_error_acknowledgment(self):
         """Send error acknowledgment signal to PLC"""
         if self.n_ack_basket is not None:
             try:
-                # (!!!) FIX: ใช้วิธี _dv_bool (!!!)
-                print("[QR] Sending ERROR ACK")
-                self.n_ack_basket.set_value(self._dv_bool(True))
-                time.sleep(0.2)  # pulse ยาวกว่าปกติ (200ms)
-                self.n_ack_basket.set_value(self._dv_bool(False))
+                log.info("[QR] Sending ERROR ACK")
+                self._pulse_ack(0.2)  # pulse ยาวกว่าปกติ (200ms)
             except Exception as e:
-                print(f"[ERROR] Failed to send error acknowledgment: {e}")
+                log.error("[ERROR] Failed to send error acknowledgment: %s", e)
 
     def _process_qr_code(self, qr_code: str):
         """
         Process a QR code by adding it to the appropriate queue in the database
         """
-        print("[QR]", qr_code)
-        # Get basket mapping data
+        log.info("[QR] %s", qr_code)
+        # Normalize once here; every DB call below takes the canonical BasketId as-is
         try:
-            mapping = self.db.get_mapping_for_basket(qr_code)
-            if not mapping:
-                print(f"[ERROR] ⚠️ Basket '{qr_code}' not registered in system database")
-                print("[INFO] Please add basket data to the system before using")
-                self._send_error_acknowledgment()  # ส่งสัญญาณแจ้งเตือนไปยัง PLC
-                return
-            shelf_id, x, y, z = mapping
-        except Exception as e:
-            print(f"[ERROR] Failed to get mapping for basket '{qr_code}': {e}")
+            qr_code = to_basket_id(qr_code)
+        except ValueError as e:
+            log.error("[ERROR] Invalid basket QR '%s': %s", qr_code, e)
             self._send_error_acknowledgment()
             return
 
-        # Verify basket storage status
+        # ถ้าระบบ ASRS ไม่พร้อม ให้ข้ามการ enqueue เพื่อไม่ให้รบกวนงานปัจจุบัน
+        # เช็คก่อนแตะ DB (subscription cache / batched poll value: no extra round-trip)
         try:
-            occupied_shelf = self.db.get_shelf_of_basket(qr_code)
-        except Exception as e:
-            occupied_shelf = None
-            print(f"[WARN] error checking current shelf for '{qr_code}': {e}")
-
-        # Skip if basket already stored
-        if occupied_shelf is not None:
-            if occupied_shelf == shelf_id:
-                print(f"[INFO] Basket {qr_code} is already stored on shelf {shelf_id}")
-            else:
-                print(f"[ERROR] Basket {qr_code} is recorded on shelf {occupied_shelf} but mapped to {shelf_id}")
+            ready = self._asrs_ready()
+        except Exception:
+            ready = True
+        if not ready:
+            log.info("[PUT-ENQ] ASRS busy, skipping enqueue for %s", qr_code)
             return
 
-        # Check target shelf status and availability
+        # All checks + INSERT in one DB round-trip (no gap between check and insert)
         try:
-            with self.db.cursor() as c:
-                c.execute("""
-                    SELECT basket_id, active 
-                    FROM shelf_data 
-                    WHERE shelf_id = %s
-                """, (shelf_id,))
-                shelf_info = c.fetchone()
-                
-                if shelf_info:
-                    current_basket = shelf_info['basket_id']
-                    is_active = shelf_info['active']
-                    
-                    if is_active:
-                        print(f"[ERROR] Shelf {shelf_id} is currently active and cannot be used")
-                        return
-                    
-                    if current_basket:
-                        if current_basket == qr_code:
-                            print(f"[INFO] Basket {qr_code} already occupies shelf {shelf_id}")
-                        else:
-                            print(f"[ERROR] Shelf {shelf_id} is occupied by {current_basket}")
-                        return
-                else:
-                    print(f"[ERROR] Shelf {shelf_id} not found in database")
-                    return
-                    
+            res = self.db.try_enqueue_put(qr_code)
         except Exception as e:
-            print(f"[WARN] Error checking shelf {shelf_id} status: {e}")
-            return
-
-        # Check shelf usability
-        try:
-            if not self.db.shelf_can_use(shelf_id):
-                print("This shelf can't use now.")
-                return
-        except Exception as e:
-            print(f"[WARN] error checking shelf usability: {e}")
+            log.error("[ERROR] Failed to process PUT for %s: %s", qr_code, e)
+            self._send_error_acknowledgment()
             return
 
-        # เพิ่มการล็อคเพื่อป้องกันการเพิ่มคำสั่งซ้ำ
-        with self.db.cursor() as c:
-            try:
-                # ตรวจสอบว่ามีคำสั่ง PUT ค้างอยู่หรือไม่
-                c.execute(
-                    "SELECT 1 FROM queue_put WHERE basket = %s LIMIT 1",
-                    (qr_code,)
-                )
-                if c.fetchone():
-                    print(f"[PUT-ENQ] duplicate ignored for {qr_code}")
-                    return
-                
-                # ถ้าระบบ ASRS ไม่พร้อม ให้ข้ามการ enqueue เพื่อไม่ให้รบกวนงานปัจจุบัน
-                try:
-                    if getattr(self, 'n_asrs_ready', None) is not None:
-                        try:
-                            ready = bool(self.n_asrs_ready.get_value())
-                        except Exception:
-                            ready = True
-                    else:
-                        ready = True
-                except Exception:
-                    ready = True
-
-                if not ready:
-                    print(f"[PUT-ENQ] ASRS busy, skipping enqueue for {qr_code}")
-                    return
-
-                c.execute(
-                    "INSERT INTO queue_put (basket, x, y, z) VALUES (%s, %s, %s, %s)",
-                    (qr_code, x, y, z)
-                )
-                print(f"[PUT-ENQ] Added {qr_code} to queue for shelf {shelf_id}")
-            except Exception as e:
-                print(f"[ERROR] Failed to process PUT for {qr_code}: {e}")
+        status = res["status"]
+        if status == Pg.ENQ_ALREADY_STORED:
+            outcome = _ENQ_STORED_HERE if res["occupied_shelf"] == res["shelf_id"] else _ENQ_STORED_ELSEWHERE
+        else:
+            outcome = _ENQ_OUTCOMES[status]
+        level, msg, error_ack = outcome
+        log.log(level, msg, {**res, "basket": qr_code})
+        if error_ack:
+            self._send_error_acknowledgment()
 
     def loop(self, callback=None, edge_only=True, validate=True):
         current_qr = None 
         while not self._stop:
             try:
-                # Get PLC send flag status
+                # ช่วง debounce หลัง flag ตก: ยังไม่อ่าน flag จนหมดเวลา (ไม่ block ด้วย sleep
+                # ตายตัว; stop() ปลุกได้ และ rise ที่ latch ไว้ระหว่างนี้ยังไม่ถูกใช้)
+                remaining = self._debounce_until - time.monotonic()
+                if remaining > 0:
+                    self._wait_next(remaining)
+                    continue
+
+                # Get PLC send flag status (subscription cache, else one batched read)
                 try:
-                    flag = bool(self.n_flag.get_value())
+                    flag, qr_raw = self._read_signals()
                 except Exception:
                     flag = False
                     time.sleep(self.interval)
@@ -210,27 +349,32 @@ class QrListener:
                 if not flag and self._last_flag:
                     self._last_qr = None
                     current_qr = None
-                    print("[QR] Flag dropped, reset states")
-                    time.sleep(0.2) 
+                    log.info("[QR] Flag dropped, reset states")
+                    self._debounce_until = time.monotonic() + 0.2
 
                 if flag:
-                    # Get QR code from PLC
+                    # Get QR code from PLC: read directly, so a flag notification that
+                    # arrives before the QR value's never pairs with the previous code
                     try:
-                        qr = str(self.n_qr.get_value() or "").strip()
+                        if qr_raw is None:
+                            qr_raw = self.n_qr.get_value()
+                        # the QR node is a String: no str() round-trip for the common case
+                        qr = qr_raw.strip() if type(qr_raw) is str else (str(qr_raw).strip() if qr_raw else "")
                     except Exception as e:
-                        print(f"[ERROR] Failed to read QR code: {e}")
+                        log.error("[ERROR] Failed to read QR code: %s", e)
                         time.sleep(self.interval)
                         continue
 
-                    # Validate QR format
-                    ok = (not validate) or (len(qr) == 10 and qr.startswith("B"))
+                    # Validate QR format (cheap shape check only; _process_qr_code
+                    # normalizes it once with to_basket_id and error-ACKs bad ids)
+                    ok = (not validate) or (len(qr) == 10 and qr[:1] == "B")
                     
                     # Handle valid QR code
                     if ok and qr:
                         if current_qr != qr: 
                             current_qr = qr
                             self._last_qr = qr
-                            print(f"[QR] Processing new code: {qr}")
+                            log.info("[QR] Processing new code: %s", qr)
                             
                             self._process_qr_code(qr)
                             
@@ -240,16 +384,13 @@ class QrListener:
                             # Send acknowledgment to PLC with current QR
                             if self.n_ack_basket is not None:
                                 try:
-                                    # (!!!) FIX: ใช้วิธี _dv_bool (!!!)
-                                    print(f"[QR] Sending ACK for: {qr}")
-                                    self.n_ack_basket.set_value(self._dv_bool(True))
-                                    time.sleep(0.1)  # เพิ่มเวลา pulse
-                                    self.n_ack_basket.set_value(self._dv_bool(False))
+                                    log.info("[QR] Sending ACK for: %s", qr)
+                                    self._pulse_ack(0.1)  # เพิ่มเวลา pulse
                                 except Exception as e:
-                                    print(f"[ERROR] Failed to send ACK: {e}")
+                                    log.error("[ERROR] Failed to send ACK: %s", e)
 
                 self._last_flag = flag
-                time.sleep(self.interval)
+                self._wait_next()
             except Exception as e:
-                print("[QR loop error]", e)
+                log.error("[QR loop error] %s", e)
                 time.sleep(self.interval)
\ No newline at end of file
@@ -1,30 +1,45 @@
 import os
 import re
+from functools import lru_cache
+from typing import NewType
 
 # Basket ID normalization
-_DIGITS = re.compile(r"^\d+$")
-_BASKET = re.compile(r"^[bB](\d{1,9})$")  # B + up to 9 digits
+# One scan for both accepted forms: bare digits (range-checked below) | B + up to 9 digits
+_BASKET_ANY = re.compile(r"^(?:(\d+)|[bB](\d{1,9}))$")
+
+@lru_cache(maxsize=4096)
+def _norm_int(n: int) -> str:
+    if not (0 <= n <= 999_999_999):
+        raise ValueError("basket number must be 0..999999999")
+    return f"B{n:09d}"
+
+@lru_cache(maxsize=4096)
+def _norm_str(s: str) -> str:
+    m = _BASKET_ANY.match(s.strip())
+    if m is None:
+        raise ValueError("invalid basket id/number format")
+    return _norm_int(int(m.group(1) or m.group(2)))
 
 def normalize_basket_id(value) -> str:
-    """Convert int/str to standard 10-char basket ID: 'B' + 9 digits (zero-padded)"""
+    """
+    Convert int/str to standard 10-char basket ID: 'B' + 9 digits (zero-padded).
+    Results are memoized per input (basket cardinality is small); invalid
+    inputs raise ValueError and are not cached.
+    """
     if value is None:
         raise ValueError("basket_id is required")
+    # bool is an int subclass but was never a valid basket number
+    if type(value) is int:
+        return _norm_int(value)
+    return _norm_str(str(value))
 
-    s = str(value).strip()
-    if _DIGITS.match(s):
-        n = int(s)
-        if not (0 <= n <= 999_999_999):
-            raise ValueError("basket number must be 0..999999999")
-        return f"B{n:09d}"
+# A basket id already in canonical form ('B' + 9 digits). Produced once at the
+# ingress boundary (QR listener / API) so DB methods can use it as-is.
+BasketId = NewType("BasketId", str)
 
-    m = _BASKET.match(s)
-    if m:
-        n = int(m.group(1))
-        if not (0 <= n <= 999_999_999):
-            raise ValueError("basket number must be 0..999999999")
-        return f"B{n:09d}"
-
-    raise ValueError("invalid basket id/number format")
+def to_basket_id(raw) -> BasketId:
+    """Normalize a raw QR / request value into a BasketId (ValueError if invalid)."""
+    return BasketId(normalize_basket_id(raw))
 
 # Environment variable helpers
 def _get_int_env(name: str, default: int) -> int:
@@ -54,20 +69,39 @@ ENC_REF_Y = _get_int_env("ENC_REF_Y", 28720)
 # step ต่อ 1 ช่อง (pulse per cell)
 STEP_X = _get_float_env("STEP_X", 20000.0)
 STEP_Y = _get_float_env("STEP_Y", 17127.0)  # เฉลี่ยจากข้อมูลที่วัดจริง
+# ส่วนกลับคำนวณครั้งเดียว: คูณแทนหารในทุก conversion
+_INV_STEP_X = 1.0 / STEP_X
+_INV_STEP_Y = 1.0 / STEP_Y
 
+@lru_cache(maxsize=4096)
 def encoder_to_position(ex: int, ey: int) -> tuple[int, int]:
     """
     แปลง Encoder X,Y -> พิกัดช่อง (x_column, y_row)
     ใช้ "REF (1,1)" เป็น anchor ของ lattice เพื่อความแม่นยำกว่า Home
+    (pure function: memoized, ค่าที่ encoder ค้างอยู่ซ้ำบ่อย)
     """
     dx = ex - ENC_REF_X
     dy = ey - ENC_REF_Y
-    x_col = REF_COL + round(dx / STEP_X)
-    y_row = REF_ROW + round(dy / STEP_Y)
-    if x_col < 1: x_col = 1
-    if y_row < 1: y_row = 1
+    x_col = max(1, REF_COL + round(dx * _INV_STEP_X))
+    y_row = max(1, REF_ROW + round(dy * _INV_STEP_Y))
     return int(x_col), int(y_row)
 
+def encoder_to_position_batch(ex, ey):
+    """
+    encoder_to_position สำหรับทั้ง array (log replay / วิเคราะห์ย้อนหลัง)
+    คืน (x_cols, y_rows) เป็น int32 arrays; numpy import เฉพาะตอนเรียก
+    (round-half-even เหมือน round() ของ Python)
+    """
+    import numpy as np
+    ex = np.asarray(ex, dtype=np.float64)
+    ey = np.asarray(ey, dtype=np.float64)
+    x = (REF_COL + np.rint((ex - ENC_REF_X) * _INV_STEP_X)).astype(np.int32)
+    y = (REF_ROW + np.rint((ey - ENC_REF_Y) * _INV_STEP_Y)).astype(np.int32)
+    np.maximum(x, 1, out=x)
+    np.maximum(y, 1, out=y)
+    return x, y
+
+@lru_cache(maxsize=4096)
 def position_to_encoder(x_col: int, y_row: int) -> tuple[int, int]:
     """
     พิกัดช่อง -> encoder ศูนย์กลางโดยประมาณ (ใช้ตรวจ/แสดงผล)